@@ -54,14 +54,14 @@ def add_cookie(cookie,string,keys):
     return cookie
 
 
-def get_BAIDUID():
+def get_BAIDUID(session=requests):
     url = ''.join([
                     PASSPORT_URL,
                     '?getapi&tpl=mn&apiver=v3',
                     '&tt=', timestamp,
                     '&class=login&logintype=basicLogin',
                     ])
-    req = requests.get(url, headers={'Referer': ''}, timeout=50, verify=False)
+    req = session.get(url, headers={'Referer': ''}, timeout=50, verify=False)
     if req:
         cookie = req.cookies.get_dict()
         cookie['cflag'] = '65535%3A1'
@@ -71,7 +71,7 @@ def get_BAIDUID():
         return None
 
 
-def get_token(cookie):
+def get_token(cookie, session=requests):
     url = ''.join([
                     PASSPORT_URL,
                     '?getapi&tpl=mn&apiver=v3',
@@ -89,7 +89,7 @@ def get_token(cookie):
     for key in headers.keys():
         headers_merged[key] = headers[key]
 
-    req = requests.get(url, headers=headers_merged, cookies=cookie, timeout=50, verify=False)
+    req = session.get(url, headers=headers_merged, cookies=cookie, timeout=50, verify=False)
     if req:
         hosupport = req.headers['Set-Cookie']
         content_obj = json_loads_single(req.text)
@@ -99,7 +99,7 @@ def get_token(cookie):
     return None
 
 
-def get_UBI(cookie, tokens):
+def get_UBI(cookie, tokens, session=requests):
     url = ''.join([
 
                     PASSPORT_URL,
@@ -115,14 +115,14 @@ def get_UBI(cookie, tokens):
     for key in headers.keys():
         headers_merged[key] = headers[key]
 
-    req=requests.get(url, headers=headers_merged, cookies=cookie, timeout=50, verify=False)
+    req=session.get(url, headers=headers_merged, cookies=cookie, timeout=50, verify=False)
     if req:
         ubi=req.headers['Set-Cookie']
         return ubi
     return None
 
 
-def get_public_key(cookie, tokens):
+def get_public_key(cookie, tokens, session=requests):
     url = ''.join([
                     PASSPORT_BASE,
                     'v2/getpublickey',
@@ -138,14 +138,14 @@ def get_public_key(cookie, tokens):
     for key in headers.keys():
         headers_merged[key] = headers[key]
 
-    req = requests.get(url, headers=headers_merged, cookies=cookie, timeout=50, verify=False)
+    req = session.get(url, headers=headers_merged, cookies=cookie, timeout=50, verify=False)
     if req:
         data = json_loads_single(req.text)
         return data
     return None
 
 
-def post_login(cookie, tokens, username, password_enc, rsakey='', verifycode='', codeString=''):
+def post_login(cookie, tokens, username, password_enc, rsakey='', verifycode='', codeString='', session=requests):
     url=PASSPORT_LOGIN
     headers={
             'Accept': ACCEPT_HTML,
@@ -184,7 +184,7 @@ def post_login(cookie, tokens, username, password_enc, rsakey='', verifycode='',
         'callback':'parent.bd__pcbs__28g1kg',
 
         }
-    req = requests.post(url, headers=headers_merged, cookies=cookie, data=data, timeout=50, verify=False)
+    req = session.post(url, headers=headers_merged, cookies=cookie, data=data, timeout=50, verify=False)
     content = req.text
     if content:
         match = re.search('"(err_no[^"]+)"', content)
@@ -208,7 +208,7 @@ def post_login(cookie, tokens, username, password_enc, rsakey='', verifycode='',
         return (-1, None)
 
 
-def get_signin_vcode(cookie, codeString, downloadPath=""):
+def get_signin_vcode(cookie, codeString, downloadPath="", session=requests):
         url=''.join([
                         PASSPORT_BASE,
                         'cgi-bin/genimage?',
@@ -223,7 +223,7 @@ def get_signin_vcode(cookie, codeString, downloadPath=""):
         #merge the headers
         for key in headers.keys():
             headers_merged[key] = headers[key]
-        req=requests.get(url, headers=headers_merged, cookies=cookie, timeout=50, verify=False)
+        req=session.get(url, headers=headers_merged, cookies=cookie, timeout=50, verify=False)
         #vcode_data is bytes
         vcode_data=req.content
         if vcode_data:
@@ -234,7 +234,7 @@ def get_signin_vcode(cookie, codeString, downloadPath=""):
         return None
 
 
-def get_refresh_codeString(cookie, tokens, vcodetype):
+def get_refresh_codeString(cookie, tokens, vcodetype, session=requests):
     url = ''.join([
         PASSPORT_BASE,
         'v2/?reggetcodestr',
@@ -248,7 +248,7 @@ def get_refresh_codeString(cookie, tokens, vcodetype):
     headers_merged = default_headers.copy()
     headers_merged.update({'Referer': REFERER})
 
-    req = requests.get(url, headers=headers_merged, cookies=cookie, timeout=50, verify=False)
+    req = session.get(url, headers=headers_merged, cookies=cookie, timeout=50, verify=False)
     if req:
         req.encoding = 'gbk'
         return json.loads(req.text)
@@ -256,10 +256,10 @@ def get_refresh_codeString(cookie, tokens, vcodetype):
     return None
 
 
-def refresh_vcode(cookie, tokens, vcodetype, downloadPath=""):
-    _info = get_refresh_codeString(cookie, tokens, vcodetype)
+def refresh_vcode(cookie, tokens, vcodetype, downloadPath="", session=requests):
+    _info = get_refresh_codeString(cookie, tokens, vcodetype, session=session)
     codeString = _info['data']['verifyStr']
-    vcode_path = get_signin_vcode(cookie, codeString, downloadPath)
+    vcode_path = get_signin_vcode(cookie, codeString, downloadPath, session=session)
     return (codeString, vcode_path)
 
 
@@ -275,11 +275,11 @@ def parse_bdstoken(content):
 
 
 #get baidu accout token
-def get_bdstoken(temp_cookie):
+def get_bdstoken(temp_cookie, session=requests):
     url = PAN_REFERER
     headers_merged = default_headers.copy()
 
-    req = requests.get(url, headers=headers_merged, cookies=temp_cookie, timeout=50, verify=False)
+    req = session.get(url, headers=headers_merged, cookies=temp_cookie, timeout=50, verify=False)
     req.encoding = 'utf-8'
     if req:
         _cookie = req.headers['Set-Cookie']
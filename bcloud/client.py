@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+pcs api bound to one account, sharing one keep-alive session
+"""
+import requests
+from multiprocessing.pool import ThreadPool
+from bcloud import pcs
+
+
+class PcsClient(object):
+    def __init__(self, cookie, tokens, session=None, list_workers=4, page_size=100, pool=None,
+                 timer=None):
+        self.cookie = cookie
+        self.tokens = tokens
+        self.session = session if session else requests.Session()
+        self.session.headers.update(pcs.default_headers)
+        self.session.cookies.update(cookie)
+        # pages after the first one are fetched list_workers at a time
+        # on `pool` (anything with a ThreadPool-like map), one at a time
+        # where pool.inline() says its map would run them serially
+        self.list_workers = list_workers
+        self.page_size = page_size
+        if pool is None and list_workers > 1:
+            pool = ThreadPool(list_workers)
+        self.pool = pool
+        # timer(name) -> context manager around each api call, whose value
+        # gets `failed` set when the call returns nothing (see metrics.timed)
+        self.timer = timer
+
+    def _width(self):
+        """pages fetched at once, 1 when the pool would fetch them serially
+
+        Then each page is checked for the end of the listing before the
+        next one is requested.
+        """
+        inline = getattr(self.pool, 'inline', None)
+        if inline is not None and inline():
+            return 1
+        return self.list_workers
+
+    def _call(self, name, func, *args, **kwargs):
+        if self.timer is None:
+            return func(*args, **kwargs)
+        with self.timer(name) as call:
+            result = func(*args, **kwargs)
+            call.failed = result is None
+        return result
+
+    def list_dir(self, path, page=1, num=None):
+        return self._call('list_dir', pcs.list_dir, self.cookie, self.tokens, path, page,
+                          num or self.page_size, session=self.session)
+
+    def list_dir_all(self, path):
+        return pcs.list_dir_all(self.cookie, self.tokens, path, session=self.session,
+                                num=self.page_size, pool=self.pool, width=self._width(),
+                                page_func=lambda page: self.list_dir(path, page))
+
+    def get_category(self, category, page=1):
+        return self._call('get_category', pcs.get_category, self.cookie, self.tokens, category, page,
+                          session=self.session)
+
+    def get_category_all(self, category, max_pages=None):
+        return pcs.get_all_pages(lambda page: self.get_category(category, page), key='info',
+                                 pool=self.pool, width=self._width(), max_pages=max_pages,
+                                 num=pcs.FULL_PAGE)
+
+    def get_download_link(self, path):
+        return self._call('get_download_link', pcs.get_download_link, self.cookie, self.tokens, path,
+                          session=self.session)
+
+    def get_dlink_location(self, dlink):
+        return self._call('get_dlink_location', pcs.get_dlink_location, self.cookie, dlink,
+                          session=self.session)
+
+    def get_final_url(self, url):
+        return self._call('get_final_url', pcs.get_final_url, self.cookie, url, session=self.session)
+
+    def stream_download(self, path):
+        return self._call('stream_download', pcs.stream_download, self.cookie, self.tokens, path,
+                          session=self.session)
+
+    def get_streaming_playlist(self, path, video_type='M3U8_AUTO_480'):
+        return self._call('get_streaming_playlist', pcs.get_streaming_playlist, self.cookie, path,
+                          video_type, session=self.session)
+
+    def get_metas(self, filelist, dlink=True):
+        return self._call('get_metas', pcs.get_metas, self.cookie, self.tokens, filelist, dlink,
+                          session=self.session)
+
+    def search(self, key, path='/', page=1):
+        return self._call('search', pcs.search, self.cookie, self.tokens, key, path, page,
+                          session=self.session)
+
+    def search_all(self, key, path='/', max_pages=None):
+        return pcs.get_all_pages(lambda page: self.search(key, path, page), pool=self.pool,
+                                 width=self._width(), max_pages=max_pages)
+
+    def mkdir(self, path):
+        return self._call('mkdir', pcs.mkdir, self.cookie, self.tokens, path, session=self.session)
+
+    def delete_files(self, filelist):
+        return self._call('delete_files', pcs.delete_files, self.cookie, self.tokens, filelist,
+                          session=self.session)
+
+    def move(self, filelist):
+        return self._call('move', pcs.move, self.cookie, self.tokens, filelist, session=self.session)
+
+    def rapid_upload(self, path, size, content_md5, slice_md5):
+        return self._call('rapid_upload', pcs.rapid_upload, self.cookie, self.tokens, path, size,
+                          content_md5, slice_md5, session=self.session)
+
+    def upload(self, path, data):
+        return self._call('upload', pcs.upload, self.cookie, path, data, session=self.session)
+
+    def slice_upload(self, data):
+        return self._call('slice_upload', pcs.slice_upload, self.cookie, data, session=self.session)
+
+    def create_superfile(self, path, block_list):
+        return self._call('create_superfile', pcs.create_superfile, self.cookie, path, block_list,
+                          session=self.session)
+
+    def map(self, func, seq):
+        """run func over seq on the client's pool"""
+        if self.pool is None:
+            return map(func, seq)
+        return self.pool.map(func, seq)
@@ -5,7 +5,7 @@
 # in http://www.gnu.org/licenses/gpl-3.0.html
 
 
-import json, os, re, time, random
+import json, os, re, time, random, urlparse
 import requests
 
 
@@ -19,11 +19,14 @@ CONTENT_FORM_UTF8 = CONTENT_FORM + '; charset=UTF-8'
 PCS_URL = 'http://pcs.baidu.com/rest/2.0/pcs/'
 # 下载的服务器名
 PCS_URL_D = 'http://d.pcs.baidu.com/rest/2.0/pcs/'
+# 上传的服务器名
+PCS_URL_C = 'http://c.pcs.baidu.com/rest/2.0/pcs/'
 ## HTTP 请求时的一些常量
 ACCEPT_HTML = 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8'
 
 
 RAPIDUPLOAD_THRESHOLD = 256 * 1024  # 256K
+FULL_PAGE = 100  # 已知服务器会按每页这么多条返回列表
 
 
 default_headers = {
@@ -37,11 +40,11 @@ default_headers = {
 }
 
 
-def get_user_uk(cookie, tokens):
+def get_user_uk(cookie, tokens, session=requests):
     '获取用户的uk'
     url = 'http://yun.baidu.com'
     headers_merged = default_headers.copy()
-    req = requests.get(url, cookies=cookie, headers=headers_merged, timeout=50, verify=False)
+    req = session.get(url, cookies=cookie, headers=headers_merged, timeout=50, verify=False)
     if req:
         content = req.text
         match = re.findall('/share/home\?uk=(\d+)" target=', content)
@@ -53,7 +56,7 @@ def get_user_uk(cookie, tokens):
 
 
 
-def get_user_info(tokens, uk):
+def get_user_info(tokens, uk, session=requests):
     '''获取用户的部分信息.
 
     比如头像, 用户名, 自我介绍, 粉丝数等.
@@ -71,7 +74,7 @@ def get_user_info(tokens, uk):
     headers_merged = default_headers.copy()
     headers_merged['Referer'] = 'http://yun.baidu.com/share/home?uk=' + uk
     headers_merged['Host'] = 'yun.baidu.com'
-    req = requests.get(url, headers=headers_merged, params=url_params, timeout=50, verify=False)
+    req = session.get(url, headers=headers_merged, params=url_params, timeout=50, verify=False)
     if req:
         info = json.loads(req.text)
         if info and info['errno'] == 0:
@@ -79,27 +82,61 @@ def get_user_info(tokens, uk):
     return None
 
 
-def get_pcs_info(cookie, tokens):
-    uk = get_user_uk(cookie, tokens)
-    pcs_info = get_user_info(tokens, uk)
+def get_pcs_info(cookie, tokens, session=requests):
+    uk = get_user_uk(cookie, tokens, session=session)
+    pcs_info = get_user_info(tokens, uk, session=session)
     return pcs_info
 
 
-def list_dir_all(cookie, tokens, path):
-    '''得到一个目录中所有文件的信息, 并返回它的文件列表'''
-    pcs_files = []
-    page = 1
-    while True:
-        content = list_dir(cookie, tokens, path, page)
-        if not content:
-            return None
-        if not content['list']:
-            return pcs_files
-        pcs_files.extend(content['list'])
-        page = page + 1
+def list_dir_all(cookie, tokens, path, session=requests, num=100, pool=None, width=1,
+                 page_func=None):
+    '''得到一个目录中所有文件的信息, 并返回它的文件列表
+
+    pool  - 线程池, 第一页之后每次并行获取width页, 直到遇到空页为止.
+    page_func - page_func(page)代替list_dir获取一页.
+    '''
+    if page_func is None:
+        page_func = lambda p: list_dir(cookie, tokens, path, p, num, session=session)
+    return get_all_pages(page_func, pool=pool, width=width,
+                         num=num if num <= FULL_PAGE else None)
 
 
-def list_dir(cookie, tokens, path, page=1, num=100):
+def get_all_pages(page_func, key='list', pool=None, width=1, max_pages=None, num=None):
+    '''依次获取page_func(page)的各页, 合并content[key]的列表, 直到遇到空页为止.
+
+    max_pages - 最多获取的页数.
+    num - 服务器确实按每页num条返回时, 遇到不满num条的页也停止. 默认为None,
+          以免服务器每页返回的条数少于请求的条数时漏掉后面的页.
+    某一页失败或errno不为0时返回None.
+    '''
+    content = page_func(1)
+    if not content or content.get('errno', 0) != 0:
+        return None
+    pcs_files = content.get(key) or []
+    if not pcs_files or (num is not None and len(pcs_files) < num):
+        return pcs_files
+    page = 2
+    while max_pages is None or page <= max_pages:
+        n = width if pool is not None and width > 1 else 1
+        if max_pages is not None:
+            n = min(n, max_pages - page + 1)
+        if n == 1:
+            contents = [page_func(page)]
+        else:
+            contents = pool.map(page_func, range(page, page+n))
+        for content in contents:
+            if not content or content.get('errno', 0) != 0:
+                return None
+            if not content.get(key):
+                return pcs_files
+            pcs_files.extend(content[key])
+            if num is not None and len(content[key]) < num:
+                return pcs_files
+        page = page + len(contents)
+    return pcs_files
+
+
+def list_dir(cookie, tokens, path, page=1, num=100, session=requests):
     '''得到一个目录中的所有文件的信息(最多100条记录).'''
     '''每页100条记录是网页规定'''
     url = PAN_API_URL + 'list'
@@ -121,7 +158,7 @@ def list_dir(cookie, tokens, path, page=1, num=100):
     headers_merged = default_headers.copy()
     headers_merged.update({'Content-type': CONTENT_FORM_UTF8})
 
-    req = requests.get(url, headers=headers_merged, cookies=cookie, params=url_params, timeout=50, verify=False)
+    req = session.get(url, headers=headers_merged, cookies=cookie, params=url_params, timeout=50, verify=False)
     if req:
         content = req.text
         return json.loads(content)
@@ -130,7 +167,7 @@ def list_dir(cookie, tokens, path, page=1, num=100):
 
 
 
-def get_category(cookie, tokens, category, page=1):
+def get_category(cookie, tokens, category, page=1, session=requests):
     '''获取一个分类中的所有文件信息, 比如音乐/图片
 
     目前的有分类有:
@@ -151,10 +188,10 @@ def get_category(cookie, tokens, category, page=1):
         '&page=', str(page),
         '&order=time&desc=1',
         '&_=', timestamp,
-        '&bdstoken=', cookie['STOKEN'],
+        '&bdstoken=', tokens['bdstoken'],
     ])
     headers_merged = default_headers.copy()
-    req = requests.get(url, cookies=cookie, headers=headers_merged, timeout=50, verify=False)
+    req = session.get(url, cookies=cookie, headers=headers_merged, timeout=50, verify=False)
     if req:
         content = req.text
         return json.loads(content)
@@ -162,7 +199,7 @@ def get_category(cookie, tokens, category, page=1):
         return None
 
 
-def get_download_link(cookie, tokens, path):
+def get_download_link(cookie, tokens, path, session=requests):
     '''在下载之前, 要先获取最终的下载链接.
 
     path - 一个文件的绝对路径.
@@ -170,23 +207,35 @@ def get_download_link(cookie, tokens, path):
     @return red_url, red_url 是重定向后的URL, 如果获取失败,
             就返回原来的dlink;
     '''
-    metas = get_metas(cookie, tokens, path)
+    metas = get_metas(cookie, tokens, path, session=session)
     if (not metas or metas.get('errno', -1) != 0 or
             'info' not in metas or len(metas['info']) != 1):
         print('pcs.get_download_link(): %s' % metas)
         return None
     dlink = metas['info'][0]['dlink']
+    return get_dlink_location(cookie, dlink, session=session)
+
+
+def get_dlink_location(cookie, dlink, session=requests):
+    '''得到dlink重定向后的最终下载链接, 如果获取失败, 就返回原来的dlink'''
     url = '{0}&cflg={1}'.format(dlink, cookie['cflag'])
+    return get_final_url(cookie, url, session=session)
+
+
+def get_final_url(cookie, url, session=requests, max_redirects=5):
+    '''跟随重定向, 返回最终的下载链接'''
     headers_merged = default_headers.copy()
     headers_merged.update({'Accept': ACCEPT_HTML})
-    req = requests.get(url, headers=headers_merged, cookies=cookie, allow_redirects=False, timeout=50, verify=False)
-    if not req:
-        return url
-    else:
-        return req.headers['location']
+    for i in range(max_redirects):
+        req = session.get(url, headers=headers_merged, cookies=cookie, allow_redirects=False, stream=True, timeout=50, verify=False)
+        req.close()
+        if not req or 'location' not in req.headers:
+            return url
+        url = urlparse.urljoin(url, req.headers['location'])
+    return url
 
 
-def stream_download(cookie, tokens, path):
+def stream_download(cookie, tokens, path, session=requests):
     '''下载流媒体文件.
 
     path - 流文件的绝对路径.
@@ -197,7 +246,7 @@ def stream_download(cookie, tokens, path):
         '&path=', path,
         '&app_id=250528',
     ])
-    req = requests.get(url, cookies=cookie, stream=True, allow_redirects=False, timeout=50, verify=False)
+    req = session.get(url, cookies=cookie, stream=True, allow_redirects=False, timeout=50, verify=False)
     if req:
         return req
     else:
@@ -214,7 +263,7 @@ def get_simple_download_link(path):
     return url
 
 
-def get_streaming_playlist(cookie, path, video_type='M3U8_AUTO_480'):
+def get_streaming_playlist(cookie, path, video_type='M3U8_AUTO_480', session=requests):
     '''获取流媒体(通常是视频)的播放列表.
 
     默认得到的是m3u8格式的播放列表, 因为它最通用.
@@ -229,14 +278,14 @@ def get_streaming_playlist(cookie, path, video_type='M3U8_AUTO_480'):
         '&app_id=250528',
     ])
     headers_merged = default_headers.copy()
-    req = requests.get(url, cookies=cookie, headers=headers_merged, timeout=50, verify=False)
+    req = session.get(url, cookies=cookie, headers=headers_merged, timeout=50, verify=False)
     if req.status_code == 200:
         return req.text
     else:
         return None
 
 
-def get_metas(cookie, tokens, filelist, dlink=True):
+def get_metas(cookie, tokens, filelist, dlink=True, session=requests):
     '''获取多个文件的metadata.
 
     filelist - 一个list, 里面是每个文件的绝对路径.
@@ -262,7 +311,7 @@ def get_metas(cookie, tokens, filelist, dlink=True):
                 }
     headers_merged = default_headers.copy()
     headers_merged.update({'Content-type': CONTENT_FORM})
-    req = requests.post(url, headers=headers_merged, cookies=cookie, data=data, timeout=50, verify=False)
+    req = session.post(url, headers=headers_merged, cookies=cookie, data=data, timeout=50, verify=False)
     if req:
         content = req.text
         return json.loads(content)
@@ -270,25 +319,192 @@ def get_metas(cookie, tokens, filelist, dlink=True):
         return None
 
 
-def search(cookie, tokens, key, path='/'):
+def search(cookie, tokens, key, path='/', page=1, num=100, session=requests):
     '''搜索全部文件, 根据文件名.
 
     key - 搜索的关键词
     path - 如果指定目录名的话, 只搜索本目录及其子目录里的文件名.
+    page - 页码, 从1开始.
+    num - 每页的文件数.
     '''
-    url = ''.join([
-        PAN_API_URL,
-        'search?channel=chunlei&clienttype=0&web=1',
-        '&dir=', path,
-        '&key=', key,
-        '&recursion',
-        '&timeStamp=', latency,
-        '&bdstoken=', tokens['bdstoken'],
-    ])
+    url = PAN_API_URL + 'search'
+    url_params = {
+            'channel': 'chunlei',
+            'clienttype': '0',
+            'web': '1',
+            'dir': path,
+            'key': key,
+            'recursion': '1',
+            'page': page,
+            'num': num,
+            'timeStamp': latency,
+            'bdstoken': tokens['bdstoken'],
+            }
     headers_merged = default_headers.copy()
-    req = requests.get(url, cookies=cookie, headers=headers_merged, timeout=50, verify=False)
+    req = session.get(url, cookies=cookie, headers=headers_merged, params=url_params, timeout=50, verify=False)
     if req:
         content = req.text
         return json.loads(content)
     else:
         return None
+
+
+def mkdir(cookie, tokens, path, session=requests):
+    '''创建一个目录.
+
+    @return 新目录的信息(fs_id, path, ctime, mtime...), errno为0时成功.
+    '''
+    url = PAN_API_URL + 'create'
+    url_params = {
+            'a': 'commit',
+            'channel': 'chunlei',
+            'clienttype': '0',
+            'web': '1',
+            'bdstoken': tokens['bdstoken'],
+            }
+    data = {'path': path,
+            'isdir': '1',
+            'size': '',
+            'block_list': '[]',
+            'method': 'post',
+            }
+    headers_merged = default_headers.copy()
+    headers_merged.update({'Content-type': CONTENT_FORM_UTF8})
+    req = session.post(url, headers=headers_merged, cookies=cookie, params=url_params, data=data,
+                       timeout=50, verify=False)
+    if req:
+        return json.loads(req.text)
+    else:
+        return None
+
+
+def filemanager(cookie, tokens, opera, filelist, session=requests):
+    '''批量删除/移动/重命名/复制文件.
+
+    opera    - delete, move, rename 或 copy
+    filelist - delete时是绝对路径的列表,
+               move/copy时是[{"path": ..., "dest": 目标目录, "newname": ...}, ...]
+    '''
+    url = PAN_API_URL + 'filemanager'
+    url_params = {
+            'channel': 'chunlei',
+            'clienttype': '0',
+            'web': '1',
+            'opera': opera,
+            'bdstoken': tokens['bdstoken'],
+            }
+    data = {'filelist': json.dumps(filelist)}
+    headers_merged = default_headers.copy()
+    headers_merged.update({'Content-type': CONTENT_FORM_UTF8})
+    req = session.post(url, headers=headers_merged, cookies=cookie, params=url_params, data=data,
+                       timeout=50, verify=False)
+    if req:
+        return json.loads(req.text)
+    else:
+        return None
+
+
+def delete_files(cookie, tokens, filelist, session=requests):
+    '''删除多个文件或目录(绝对路径的列表).'''
+    return filemanager(cookie, tokens, 'delete', filelist, session=session)
+
+
+def move(cookie, tokens, filelist, session=requests):
+    '''移动多个文件或目录, filelist见filemanager().'''
+    return filemanager(cookie, tokens, 'move', filelist, session=session)
+
+
+def rapid_upload(cookie, tokens, path, size, content_md5, slice_md5, ondup='overwrite',
+                 session=requests):
+    '''秒传: 服务器上已有相同md5的文件时, 不用上传内容就可以保存为path.
+
+    size        - 文件大小, 必须大于RAPIDUPLOAD_THRESHOLD
+    content_md5 - 整个文件的md5
+    slice_md5   - 文件前RAPIDUPLOAD_THRESHOLD字节的md5
+
+    @return 成功时返回新文件的信息(path, size, md5, fs_id, ctime, mtime),
+            服务器上没有这个文件时返回None.
+    '''
+    url = PCS_URL_C + 'file'
+    url_params = {
+            'method': 'rapidupload',
+            'app_id': '250528',
+            'ondup': ondup,
+            'path': path,
+            'content-length': str(size),
+            'content-md5': content_md5,
+            'slice-md5': slice_md5,
+            'BDUSS': cookie['BDUSS'],
+            'bdstoken': tokens['bdstoken'],
+            }
+    req = session.post(url, headers=default_headers, cookies=cookie, params=url_params,
+                       timeout=50, verify=False)
+    if req:
+        return json.loads(req.text)
+    else:
+        return None
+
+
+def upload(cookie, path, data, ondup='overwrite', session=requests):
+    '''上传一个文件, 内容是data, 保存为path.
+
+    @return 新文件的信息(path, size, md5, fs_id, ctime, mtime)
+    '''
+    dir_name, file_name = os.path.split(path)
+    url = PCS_URL_C + 'file'
+    url_params = {
+            'method': 'upload',
+            'app_id': '250528',
+            'ondup': ondup,
+            'dir': dir_name,
+            'filename': file_name,
+            'BDUSS': cookie['BDUSS'],
+            }
+    req = session.post(url, headers=default_headers, cookies=cookie, params=url_params,
+                       files={'file': (' ', data)}, timeout=50, verify=False)
+    if req:
+        return json.loads(req.text)
+    else:
+        return None
+
+
+def slice_upload(cookie, data, session=requests):
+    '''上传一个分片, 之后用create_superfile()合并.
+
+    @return 分片的md5 ({"md5": ...})
+    '''
+    url = PCS_URL_C + 'file'
+    url_params = {
+            'method': 'upload',
+            'type': 'tmpfile',
+            'app_id': '250528',
+            'BDUSS': cookie['BDUSS'],
+            }
+    req = session.post(url, headers=default_headers, cookies=cookie, params=url_params,
+                       files={'file': (' ', data)}, timeout=50, verify=False)
+    if req:
+        return json.loads(req.text)
+    else:
+        return None
+
+
+def create_superfile(cookie, path, block_list, ondup='overwrite', session=requests):
+    '''把slice_upload()上传的分片按block_list(分片md5的列表)的顺序合并为path.
+
+    @return 新文件的信息(path, size, md5, fs_id, ctime, mtime)
+    '''
+    url = PCS_URL_C + 'file'
+    url_params = {
+            'method': 'createsuperfile',
+            'app_id': '250528',
+            'ondup': ondup,
+            'path': path,
+            'BDUSS': cookie['BDUSS'],
+            }
+    data = {'param': json.dumps({'block_list': block_list})}
+    req = session.post(url, headers=default_headers, cookies=cookie, params=url_params, data=data,
+                       timeout=50, verify=False)
+    if req:
+        return json.loads(req.text)
+    else:
+        return None
@@ -3,13 +3,29 @@
 WebDAV wrapper for Baidu Yun cloud service
 """
 from bcloud import auth, pcs
+from bcloud.client import PcsClient
 import json
+import base64
+import hashlib
+import hmac
 import os.path
-from util import UrlIO
+import re
+import time
+import tempfile
+import threading
+import requests
+from collections import OrderedDict, deque
+from util import open_url, DirEntries, LinkCache, mount_pool, _engine, _blockcache, HTTP_TIMEOUT, \
+    SequenceTracker, prefetch_next
+from engine import URGENT
+from metacache import MetaCache, MetaStore
+from metrics import timed, uploads, bytes_total
+from warmer import Warmer
+import hls
 from io import BytesIO
 from wsgidav.util import joinUri
 from wsgidav.dav_provider import DAVProvider, DAVNonCollection, DAVCollection
-from wsgidav.dav_error import DAVError, HTTP_FORBIDDEN, HTTP_INTERNAL_ERROR,\
+from wsgidav.dav_error import DAVError, HTTP_FORBIDDEN, HTTP_INTERNAL_ERROR, HTTP_BAD_GATEWAY,\
     PRECONDITION_CODE_ProtectedProperty
 from wsgidav import util
 
@@ -17,66 +33,212 @@ __docformat__ = "reStructuredText"
 
 _logger = util.getModuleLogger(__name__)
 
-from util import _dircache
-_last_path = None
-
-_video_fmts = ['avi', 'mp4', 'mkv', 'mov']
-MAX_FILES_IN_VIDEO_FOLDER = 10
+_video_fmts = set(['avi', 'mp4', 'mkv', 'mov'])
 MIN_SIZE_FOR_STREAM = 500*1024*1024
+LINK_TTL = 60*60            # lifetime of a download link without `expires`
+LINK_MARGIN = 5*60
+LINK_BATCH = 100            # paths per filemetas call
+MAX_PREFETCH_LINKS = 500
+MAX_LINK_DIRS = 1000        # folders remembered for the prefetch throttle
+VIDEO_TYPE = 'M3U8_AUTO_480'
+# transcode variants in <name>.m3u8: (suffix, video type, bandwidth hint, resolution)
+HLS_VARIANTS = [
+    ('480p', 'M3U8_AUTO_480', 800000, '854x480'),
+    ('720p', 'M3U8_AUTO_720', 1800000, '1280x720'),
+    ('1080p', 'M3U8_AUTO_1080', 3600000, '1920x1080'),
+]
+PLAYLIST_TTL = 10*60
+HLS_PREFIX = '/_hls'        # proxied segments: /_hls/<id>/<n>.ts
+HLS_PREFETCH = 3            # segments fetched ahead of the player
+SEARCH_DIR = '_search'      # /_search/<query>/: files whose name contains query
+CATEGORY_DIR = '_category'  # /_category/<name>/: files of a category
+CATEGORIES = OrderedDict([('video', 1), ('music', 2), ('image', 3), ('doc', 4),
+                          ('app', 5), ('other', 6), ('bt', 7)])
+MAX_CATEGORY_PAGES = 20     # 100 files per page
+MAX_SEARCH_PAGES = 20       # 100 files per page
+WARM_RECENT = 7*24*60*60    # videos added since are given warm playlists
+UPLOAD_CHUNK = 4*1024*1024  # tmpfile part size of chunked uploads
+UPLOAD_AHEAD = 4            # parts uploaded in parallel
+UPLOAD_SPOOL = 16*1024*1024 # PUT bodies up to this size are spooled in memory
 
 class BdyunCollection(DAVCollection):
-    """Collection"""
-    def __init__(self, path, environ):
+    """Collection
+
+    `rpath` is the folder on Baidu Yun when it differs from the DAV path
+    (members of search results) and `item` its entry in the parent listing.
+    """
+    def __init__(self, path, environ, rpath=None, item=None):
         DAVCollection.__init__(self, path, environ)
-        self.abspath = self.provider.sharePath + path
-        try:
-            self.nlist = _dircache[self.abspath]
-        except KeyError:
-            self.nlist = None
+        self.rpath = rpath or path
+        self.item = item
+        self.entries = None
         
     def getDisplayInfo(self):
         return {"type": "Collection"}
+
+    def _fetch(self):
+        nlist = self.environ['bdyun.client'].list_dir_all(self.rpath)
+        if nlist is None:
+            _logger.error("fail to read %s" % self.rpath)
+            return None
+        return index_entries(nlist)
+
+    def _load(self):
+        if self.entries is None:
+            self.entries = self.provider.dircache.get(self.rpath, self._fetch)
+            if self.entries is None:
+                return index_entries([])
+        return self.entries
+
+    def refresh(self, max_age):
+        """reload the listing if it is older than max_age seconds"""
+        self.entries = self.provider.dircache.get(self.rpath, self._fetch, max_age)
     
     def getMemberNames(self):
-        if self.nlist is None:
-            self.nlist = pcs.list_dir_all(self.environ['bdyun.cookie'], self.environ['bdyun.tokens'], self.path)
-            _dircache[self.abspath] = self.nlist
-        names = [item['server_filename'].encode('utf-8') for item in self.nlist]
-        if len(names) > MAX_FILES_IN_VIDEO_FOLDER:
-            return names
-        # m3u8
-        global _video_fmts
-        for name in names:
-            rname, ext = os.path.splitext(name)
-            if ext[1:].lower() in _video_fmts and item['size'] > MIN_SIZE_FOR_STREAM:
-                names.append(rname+'.m3u8')
-        return names
+        return self._load().member_names()
     
     def getMember(self, name):
-        if self.nlist is None:
-            self.nlist = pcs.list_dir_all(self.environ['bdyun.cookie'], self.environ['bdyun.tokens'], self.path)
-            _dircache[self.abspath] = self.nlist
-        global _video_fmts
-        for item in self.nlist:
-            bname = item['server_filename'].encode('utf-8')
-            if bname == name:
-                path = item['path'].encode('utf-8')
-                if item['isdir']:
-                    return BdyunCollection(path, self.environ)
-                else:
-                    return BdyunFile(path, self.environ, item)
-            if name.endswith('.m3u8'):
-                rname, ext = os.path.splitext(bname)
-                if name.startswith(rname) and ext[1:].lower() in _video_fmts:
-                    return BdyunStreamFile(joinUri(self.path, name), self.environ, item)
+        entries = self._load()
+        item = entries.index.get(name)
+        if item is None and self.path == '/' and name in (SEARCH_DIR, CATEGORY_DIR):
+            return BdyunQueryRoot(joinUri(self.path, name), self.environ, name)
+        if item is not None:
+            path = joinUri(self.path, name)
+            if item['isdir']:
+                return BdyunCollection(path, self.environ, item['path'].encode('utf-8'), item)
+            else:
+                return BdyunFile(path, self.environ, item)
+        item = entries.virtual.get(name)
+        if item is not None:
+            return BdyunStreamFile(joinUri(self.path, name), self.environ, item)
+        # variant playlists are not listed, only linked from the master one
+        m = re.match(r'(.+)_([^_]+)\.m3u8$', name)
+        if m is not None:
+            item = entries.virtual.get(m.group(1) + '.m3u8')
+            video_type = variant_type(m.group(2))
+            if item is not None and video_type is not None:
+                return BdyunStreamFile(joinUri(self.path, name), self.environ, item, video_type)
         return None
 
+    def createEmptyResource(self, name):
+        # nothing is stored until the PUT body is complete
+        rpath = joinUri(self.rpath, name)
+        return BdyunFile(joinUri(self.path, name), self.environ, listing_item(rpath, False, {}))
+
+    def createCollection(self, name):
+        self.provider.mkdir(joinUri(self.rpath, name))
+
+    def supportRecursiveDelete(self):
+        return True
+
+    def delete(self):
+        self.provider.remove(self.rpath)
+        self.removeAllProperties(True)
+        self.removeAllLocks(True)
+
+    def copyMoveSingle(self, destPath, isMove):
+        raise DAVError(HTTP_FORBIDDEN)
+
+    def handleMove(self, destPath):
+        return self.provider.move_resource(self, destPath, self.item)
+
+
+class BdyunQueryRoot(DAVCollection):
+    """/_search or /_category, not listed in the root folder
+
+    A real root folder of the same name takes its place.
+    """
+    def __init__(self, path, environ, kind):
+        DAVCollection.__init__(self, path, environ)
+        self.kind = kind
+
+    def getDisplayInfo(self):
+        return {"type": "Collection"}
+
+    def getMemberNames(self):
+        if self.kind == CATEGORY_DIR:
+            return CATEGORIES.keys()
+        return []
+
+    def getMember(self, name):
+        if self.kind == CATEGORY_DIR and name not in CATEGORIES:
+            return None
+        return BdyunResults(joinUri(self.path, name), self.environ, self.kind, name)
+
+    def handleDelete(self):
+        raise DAVError(HTTP_FORBIDDEN)
+
+    def handleMove(self, destPath):
+        raise DAVError(HTTP_FORBIDDEN)
+
+
+class BdyunResults(BdyunCollection):
+    """files found by one search or category query, cached like a folder"""
+    def __init__(self, path, environ, kind, arg):
+        BdyunCollection.__init__(self, path, environ)
+        self.kind = kind
+        self.arg = arg
+
+    def _fetch(self):
+        nlist = self.provider.query(self.kind, self.arg)
+        if nlist is None:
+            _logger.error("fail to query %s" % self.path)
+            return None
+        return index_entries(nlist)
+
+    # members can be changed, the results folder itself cannot
+    def createEmptyResource(self, name):
+        raise DAVError(HTTP_FORBIDDEN)
+
+    def createCollection(self, name):
+        raise DAVError(HTTP_FORBIDDEN)
+
+    def handleDelete(self):
+        raise DAVError(HTTP_FORBIDDEN)
+
+    def handleMove(self, destPath):
+        raise DAVError(HTTP_FORBIDDEN)
+
+
+def variant_type(suffix):
+    for v in HLS_VARIANTS:
+        if v[0] == suffix:
+            return v[1]
+    return None
+
+
+def index_entries(nlist):
+    """index a listing, adding a .m3u8 playlist for every large video"""
+    entries = DirEntries(nlist, lambda item: item['server_filename'].encode('utf-8'))
+    for name, item in zip(entries.names, entries.items):
+        rname, ext = os.path.splitext(name)
+        if ext[1:].lower() in _video_fmts and item['size'] > MIN_SIZE_FOR_STREAM \
+                and rname+'.m3u8' not in entries.index:
+            entries.add_virtual(rname+'.m3u8', item)
+    return entries
+
+
+def is_file(item):
+    return not item['isdir']
+
+
+def listing_item(rpath, isdir, info):
+    """listing entry of a file or folder just written, from the api response `info`"""
+    mtime = info.get('mtime') or int(time.time())
+    path = info.get('path') or rpath.decode('utf-8')
+    return {'path': path, 'server_filename': path.rsplit('/', 1)[-1], 'isdir': int(isdir),
+            'size': info.get('size', 0), 'md5': info.get('md5', ''), 'fs_id': info.get('fs_id', 0),
+            'local_mtime': mtime, 'local_ctime': info.get('ctime', mtime),
+            'server_mtime': mtime, 'server_ctime': info.get('ctime', mtime)}
+
 
 class BdyunFile(DAVNonCollection):
     """Represents a file."""
     def __init__(self, path, environ, file_info):
         DAVNonCollection.__init__(self, path, environ)
         self.file_info = file_info
+        self.rpath = file_info['path'].encode('utf-8')
+        self.upload = None
 
     def getContentLength(self):
         return self.file_info['size']
@@ -89,29 +251,154 @@ class BdyunFile(DAVNonCollection):
     def getDisplayInfo(self):
         return {"type": "File"}
     def getEtag(self):
-        return None
+        return file_etag(self.file_info)
     def getLastModified(self):
         return self.file_info['local_mtime']
     def supportRanges(self):
         return True
 
     def getContent(self):
-        url = pcs.get_simple_download_link(self.path)
-        return UrlIO(url, size=self.file_info['size'], cookies=self.environ['bdyun.cookie'], headers=pcs.default_headers)
+        provider = self.provider
+        f = self._open()
+        provider.prefetch_links(os.path.dirname(self.rpath))
+        prefetch_next(provider, self, is_file)
+        return f
+
+    def _open(self):
+        provider = self.provider
+        rpath = self.rpath
+        url = provider.get_link(rpath)
+        return open_url(url, self.file_info['size'], cookies=self.environ['bdyun.cookie'], headers=pcs.default_headers,
+                        session=self.environ['bdyun.client'].session,
+                        refresh=lambda: provider.get_link(rpath, refresh=True),
+                        cache_key=(self.provider.sharePath, rpath),
+                        stamp=(self.file_info['size'], self.file_info['local_mtime']))
+
+    def beginWrite(self, contentType=None):
+        self.upload = BdyunUpload(self.environ['bdyun.client'], self.rpath, self.provider.sharePath)
+        return self.upload
+
+    def endWrite(self, withErrors):
+        if withErrors or self.upload is None or self.upload.info is None:
+            return
+        self.file_info = listing_item(self.rpath, False, self.upload.info)
+        self.provider.update_listing(self.rpath, self.file_info)
+
+    def delete(self):
+        self.provider.remove(self.rpath)
+        self.removeAllProperties(True)
+        self.removeAllLocks(True)
+
+    def copyMoveSingle(self, destPath, isMove):
+        raise DAVError(HTTP_FORBIDDEN)
+
+    def handleMove(self, destPath):
+        return self.provider.move_resource(self, destPath, self.file_info)
+
+
+class BdyunUpload(object):
+    """write side of a PUT: spools and hashes the body, stores it on close()
+
+    Nothing is sent before the body is complete, so that a body whose md5
+    Baidu already knows is saved by rapidupload without transfer. Other
+    bodies are uploaded in one request up to UPLOAD_CHUNK, or as tmpfile
+    parts in parallel on the data lane, joined by createsuperfile.
+    """
+    def __init__(self, client, rpath, share):
+        self.client = client
+        self.rpath = rpath
+        self.share = share
+        self.spool = tempfile.SpooledTemporaryFile(UPLOAD_SPOOL)
+        self.md5 = hashlib.md5()
+        self.slice_md5 = hashlib.md5()
+        self.size = 0
+        self.info = None
+
+    def write(self, data):
+        if self.size < pcs.RAPIDUPLOAD_THRESHOLD:
+            self.slice_md5.update(data[:pcs.RAPIDUPLOAD_THRESHOLD - self.size])
+        self.md5.update(data)
+        self.spool.write(data)
+        self.size += len(data)
+
+    def close(self):
+        if self.spool.closed:
+            return
+        try:
+            info = self._store()
+        finally:
+            self.spool.close()
+        if not info or 'path' not in info:
+            _logger.error("fail to upload %s: %s" % (self.rpath, info))
+            raise DAVError(HTTP_BAD_GATEWAY)
+        self.info = info
+
+    def _store(self):
+        if self.size > pcs.RAPIDUPLOAD_THRESHOLD:
+            info = self.client.rapid_upload(self.rpath, self.size, self.md5.hexdigest(),
+                                            self.slice_md5.hexdigest())
+            if info and 'path' in info:
+                uploads.inc('rapid')
+                return info
+        self.spool.seek(0)
+        if self.size <= UPLOAD_CHUNK:
+            uploads.inc('single')
+            info = self.client.upload(self.rpath, self.spool.read())
+        else:
+            uploads.inc('chunked')
+            info = self._store_parts()
+        if info and 'path' in info:
+            bytes_total.inc(self.share, 'uploaded', amount=self.size)
+        return info
+
+    def _store_parts(self):
+        md5s = []
+        pending = deque()
+        while True:
+            data = self.spool.read(UPLOAD_CHUNK)
+            if not data:
+                break
+            if len(pending) >= UPLOAD_AHEAD:
+                md5s.append(pending.popleft().wait())
+            pending.append(_engine.data.submit(None, self.client.slice_upload, data, priority=URGENT))
+        md5s.extend(task.wait() for task in pending)
+        if not all(part and 'md5' in part for part in md5s):
+            _logger.error("fail to upload parts of %s: %s" % (self.rpath, md5s))
+            return None
+        return self.client.create_superfile(self.rpath, [part['md5'] for part in md5s])
 
 
 class BdyunStreamFile(DAVNonCollection):
-    """Represents a file."""
-    def __init__(self, path, environ, file_info):
+    """m3u8 playlist of a video
+
+    Without video_type this is the master playlist of HLS_VARIANTS, which
+    needs no upstream call; a variant playlist is fetched on first access.
+    """
+    def __init__(self, path, environ, file_info, video_type=None):
         DAVNonCollection.__init__(self, path, environ)
         self.file_info = file_info
+        self.video_type = video_type
         self.m3u = None
 
-    def getContentLength(self):
-        if self.m3u is None:
-            txt = pcs.get_streaming_playlist(self.environ['bdyun.cookie'], self.file_info['path'])
+    def _playlist(self):
+        if self.m3u is None and self.video_type is None:
+            rname = os.path.splitext(self.name)[0]
+            self.m3u = hls.master_playlist([('%s_%s.m3u8' % (rname, suffix), bandwidth, resolution)
+                                            for suffix, _, bandwidth, resolution in HLS_VARIANTS])
+        elif self.m3u is None:
+            provider = self.provider
+            path = self.file_info['path']
+            txt = provider.get_playlist(path, self.video_type)
+            if txt is None:
+                raise DAVError(HTTP_BAD_GATEWAY)
+            if provider.hls_proxy:
+                prefix = self.environ['SCRIPT_NAME'] + HLS_PREFIX + '/' + provider.hls_id(path, self.video_type)
+                txt = hls.rewrite(txt, prefix)
             self.m3u = txt.encode('utf-8')
-        return len(self.m3u)
+        return self.m3u
+
+    def getContentLength(self):
+        return len(self._playlist())
     def getContentType(self):
         return util.guessMimeType(self.path)
     def getCreationDate(self):
@@ -121,6 +408,11 @@ class BdyunStreamFile(DAVNonCollection):
     def getDisplayInfo(self):
         return {"type": "File"}
     def getEtag(self):
+        # variant playlists carry expiring segment urls unless proxied
+        if self.video_type is None:
+            return file_etag(self.file_info) + '-m3u8'
+        if self.provider.hls_proxy:
+            return '%s-%s' % (file_etag(self.file_info), self.video_type)
         return None
     def getLastModified(self):
         return None
@@ -128,35 +420,87 @@ class BdyunStreamFile(DAVNonCollection):
         return False
 
     def getContent(self):
-        if self.m3u is None:
-            txt = pcs.get_streaming_playlist(self.environ['bdyun.cookie'], self.file_info['path'])
-            self.m3u = txt.encode('utf-8')
-        return BytesIO(self.m3u)
+        return BytesIO(self._playlist())
+
+
+class BdyunHlsSegment(DAVNonCollection):
+    """media segment of a proxied HLS playlist"""
+    def __init__(self, path, environ, hid, seq):
+        DAVNonCollection.__init__(self, path, environ)
+        self.hid = hid
+        self.seq = seq
+        self.data = None
+
+    def _load(self):
+        if self.data is None:
+            self.data = self.provider.get_segment(self.hid, self.seq)
+            if self.data is None:
+                raise DAVError(HTTP_BAD_GATEWAY)
+        return self.data
+
+    def getContentLength(self):
+        return len(self._load())
+    def getContentType(self):
+        return 'video/MP2T'
+    def getCreationDate(self):
+        return None
+    def getDisplayName(self):
+        return self.name
+    def getDisplayInfo(self):
+        return {"type": "File"}
+    def getEtag(self):
+        return '%s-%d' % (self.hid, self.seq)
+    def getLastModified(self):
+        return None
+    def supportRanges(self):
+        return True
+
+    def getContent(self):
+        return BytesIO(self._load())
+
+
+def file_etag(info):
+    """strong etag of a listing entry: content md5 (or fs_id) and mtime"""
+    return '%s-%d' % (info.get('md5') or info['fs_id'], info.get('server_mtime', info['local_mtime']))
+
+
+def link_expires(url):
+    """expiry time of a download link from its `expires` parameter"""
+    now = time.time()
+    m = re.search(r'[?&]expires=(\d+)(h?)', url)
+    if m:
+        n = int(m.group(1))
+        if m.group(2):
+            return now + n*3600 - LINK_MARGIN
+        if n > now:     # timestamp
+            return n - LINK_MARGIN
+    return now + LINK_TTL - LINK_MARGIN
 
 
 def bdyun_login(username, password):
-    cookie = auth.get_BAIDUID()
-    token = auth.get_token(cookie)
+    session = requests.Session()
+    cookie = auth.get_BAIDUID(session=session)
+    token = auth.get_token(cookie, session=session)
     tokens = {'token':token}
-    ubi = auth.get_UBI(cookie, tokens)
+    ubi = auth.get_UBI(cookie, tokens, session=session)
     cookie = auth.add_cookie(cookie, ubi, ['UBI','PASSID'])
-    key_data = auth.get_public_key(cookie, tokens)
+    key_data = auth.get_public_key(cookie, tokens, session=session)
     pubkey = key_data['pubkey']
     rsakey = key_data['key']
     password_enc = auth.RSA_encrypt(pubkey, password)
-    err_no, query = auth.post_login(cookie, tokens, username, password_enc, rsakey)
+    err_no, query = auth.post_login(cookie, tokens, username, password_enc, rsakey, session=session)
     if err_no == 257:
         vcodetype = query['vcodetype']
         codeString = query['codeString']
-        vcode_path = auth.get_signin_vcode(cookie, codeString)
+        vcode_path = auth.get_signin_vcode(cookie, codeString, session=session)
         print vcode_path
         verifycode = ""
         while len(verifycode) != 4:
             verifycode = raw_input("enter captcha from the above url... ")
-    err_no, query = auth.post_login(cookie, tokens, username, password_enc, rsakey, verifycode, codeString)
+    err_no, query = auth.post_login(cookie, tokens, username, password_enc, rsakey, verifycode, codeString, session=session)
     if err_no == 0:
         temp_cookie = query
-        auth_cookie, bdstoken = auth.get_bdstoken(temp_cookie)
+        auth_cookie, bdstoken = auth.get_bdstoken(temp_cookie, session=session)
         if bdstoken:
             tokens['bdstoken'] = bdstoken
             return auth_cookie, tokens
@@ -172,7 +516,10 @@ def bdyun_login(username, password):
 # DAVProvider
 #===============================================================================
 class BdyunProvider(DAVProvider):
-    def __init__(self, username, userpw, cfgpath=None):
+    def __init__(self, username, userpw, cfgpath=None,
+                 pool_connections=None, pool_maxsize=None, max_retries=None,
+                 list_workers=4, page_size=100, dircache=None, metadb=None, hls_proxy=False,
+                 hls_secret=None, warm=None):
         super(BdyunProvider, self).__init__()
         do_login = True
         if cfgpath is not None:
@@ -198,18 +545,262 @@ class BdyunProvider(DAVProvider):
                           "cookie":cookie,
                           "tokens":tokens
                          }
+        session = mount_pool(requests.Session(), pool_connections, pool_maxsize, max_retries)
+        self.client = PcsClient(cookie, tokens, session, list_workers, page_size, pool=_engine.meta,
+                                timer=timed)
+        store = MetaStore(metadb) if metadb else None
+        self.dircache = MetaCache(store=store, decode=index_entries, **(dircache or {}))
+        self.links = LinkCache()
+        self.link_dirs = OrderedDict()  # folder -> last link prefetch, LRU
+        self.link_lock = threading.Lock()
+        self.playlists = LinkCache('playlist')
+        self.hls_proxy = hls_proxy
+        # segment urls carry (path, video_type) signed with this key, so they
+        # stay valid across restarts while the login does
+        self.hls_secret = hls_secret or hashlib.sha1(json.dumps(cookie, sort_keys=True)).digest()
+        self.write_lock = threading.Lock()
+        self.sequence = SequenceTracker()
+        self.warmer = Warmer(self, **warm) if warm else None
+        if self.warmer is not None:
+            self.warmer.start()
 
     def getResourceInst(self, path, environ):
         _logger.info("getResourceInst('%s')" % path)
         self._count_getResourceInst += 1
-        global _last_path
-        npath = self.sharePath + path
-        if _last_path == npath:
-            global _dircache
-            #del _dircache[npath]
-            _dircache.__delete__(npath)
-        _last_path = npath
         environ['bdyun.cookie'] = self.user_info['cookie']
         environ['bdyun.tokens'] = self.user_info['tokens']
+        environ['bdyun.client'] = self.client
+        if self.hls_proxy and path.startswith(HLS_PREFIX + '/'):
+            return self._hls_segment(path, environ)
         root = BdyunCollection("/", environ)
         return root.resolve("", path)
+
+    def _hls_segment(self, path, environ):
+        m = re.match(r'([\w-]+\.[0-9a-f]+)/(\d+)\.ts$', path[len(HLS_PREFIX)+1:])
+        if m is None or self.hls_source(m.group(1)) is None:
+            return None
+        return BdyunHlsSegment(path, environ, m.group(1), int(m.group(2)))
+
+    def invalidate(self, path):
+        """forget cached listings of path and its subfolders"""
+        self.dircache.invalidate(path)
+
+    def remote_path(self, path, environ):
+        """Baidu Yun path for the DAV path of a MOVE destination"""
+        parent = self.getResourceInst(util.getUriParent(path), environ)
+        if not isinstance(parent, BdyunCollection) or isinstance(parent, BdyunResults):
+            raise DAVError(HTTP_FORBIDDEN)
+        return joinUri(parent.rpath, util.getUriName(path))
+
+    def mkdir(self, rpath):
+        res = self.client.mkdir(rpath)
+        if not res or res.get('errno', -1) != 0:
+            _logger.error("fail to create %s: %s" % (rpath, res))
+            raise DAVError(HTTP_BAD_GATEWAY)
+        self.update_listing(rpath, listing_item(rpath, True, res))
+
+    def remove(self, rpath):
+        if rpath == '/':
+            raise DAVError(HTTP_FORBIDDEN)
+        res = self.client.delete_files([rpath])
+        if not res or res.get('errno', -1) != 0:
+            _logger.error("fail to delete %s: %s" % (rpath, res))
+            raise DAVError(HTTP_BAD_GATEWAY)
+        self.dircache.invalidate(rpath)
+        self.update_listing(rpath)
+
+    def move_resource(self, res, destPath, item):
+        """MOVE of res by one filemanager call (handleMove of files and folders)
+
+        Handled here so that wsgidav does not list the whole source tree
+        first. An existing destination is deleted before, as wsgidav would.
+        """
+        environ = res.environ
+        destRes = self.getResourceInst(destPath, environ)
+        if destRes is not None:
+            destRes.delete()
+        self.move(res.rpath, self.remote_path(destPath, environ), item)
+        if self.propManager:
+            destRes = self.getResourceInst(destPath, environ)
+            self.propManager.moveProperties(res.getRefUrl(), destRes.getRefUrl(),
+                                            withChildren=res.isCollection, environ=environ)
+        return True
+
+    def move(self, rpath, dest, item):
+        if rpath == '/':
+            raise DAVError(HTTP_FORBIDDEN)
+        folder, name = os.path.split(dest)
+        res = self.client.move([{'path': rpath, 'dest': folder, 'newname': name}])
+        if not res or res.get('errno', -1) != 0:
+            _logger.error("fail to move %s to %s: %s" % (rpath, dest, res))
+            raise DAVError(HTTP_BAD_GATEWAY)
+        self.dircache.invalidate(rpath)
+        self.update_listing(rpath)
+        if item is None:
+            item = listing_item(dest, True, {})
+        item = dict(item, path=dest.decode('utf-8'), server_filename=name.decode('utf-8'))
+        self.update_listing(dest, item)
+
+    def update_listing(self, rpath, item=None):
+        """replace the entry of `rpath` in the cached listing of its folder by `item`
+
+        Cached search and category results are dropped.
+        """
+        folder, name = os.path.split(rpath)
+        with self.write_lock:
+            ent = self.dircache.peek(folder)
+            if ent is not None:
+                items = [i for i in ent[1].items if i['server_filename'].encode('utf-8') != name]
+                if item is not None:
+                    items.append(item)
+                self.dircache.put(folder, index_entries(items), ent[0])
+        self.links.pop(rpath)
+        self.dircache.invalidate('/' + SEARCH_DIR)
+        self.dircache.invalidate('/' + CATEGORY_DIR)
+
+    def query(self, kind, arg):
+        """files of a search (kind SEARCH_DIR) or a category, None on failure"""
+        if kind == SEARCH_DIR:
+            return self.client.search_all(arg, max_pages=MAX_SEARCH_PAGES)
+        return self.client.get_category_all(CATEGORIES[arg], MAX_CATEGORY_PAGES)
+
+    def get_link(self, path, refresh=False):
+        """final download url of a file, cached until it expires"""
+        if refresh:
+            self.links.pop(path)
+        else:
+            url = self.links.get(path)
+            if url is not None:
+                return url
+        url = pcs.get_simple_download_link(path)
+        try:
+            url = _engine.meta.call(('link', id(self), path), self.client.get_final_url, url)
+        except requests.RequestException as e:
+            _logger.warning("fail to resolve %s: %s" % (path, e))
+            return url
+        self.links.put(path, url, link_expires(url))
+        return url
+
+    def get_playlist(self, path, video_type=VIDEO_TYPE):
+        """m3u8 text of a video, cached for PLAYLIST_TTL"""
+        key = (path, video_type)
+        txt = self.playlists.get(key)
+        if txt is None:
+            txt = _engine.meta.call(('playlist', id(self)) + key,
+                                    self.client.get_streaming_playlist, path, video_type)
+            if txt is not None:
+                self.playlists.put(key, txt, time.time() + PLAYLIST_TTL)
+        return txt
+
+    def hls_id(self, path, video_type):
+        """id of a proxied playlist in its segment urls: signed (path, video_type)"""
+        data = base64.urlsafe_b64encode(json.dumps([path, video_type])).rstrip('=')
+        return '%s.%s' % (data, self._hls_sign(data))
+
+    def hls_source(self, hid):
+        """(path, video_type) of an hls id, None unless this server signed it"""
+        data, _, sig = hid.rpartition('.')
+        if not data or not hmac.compare_digest(sig, self._hls_sign(data)):
+            return None
+        path, video_type = json.loads(base64.urlsafe_b64decode(data + '=' * (-len(data) % 4)))
+        return path, video_type
+
+    def _hls_sign(self, data):
+        return hmac.new(self.hls_secret, data, hashlib.sha1).hexdigest()[:16]
+
+    def get_segment(self, hid, seq):
+        """content of segment `seq` of a proxied playlist, prefetching the next ones"""
+        key = (self.sharePath, HLS_PREFIX, hid, seq)
+        data = _blockcache.get(key)
+        if data is None:
+            data = _engine.data.call(key, self._load_segment, hid, seq)
+        for n in range(seq+1, seq+1+HLS_PREFETCH):
+            nkey = (self.sharePath, HLS_PREFIX, hid, n)
+            if nkey not in _blockcache:
+                _engine.data.submit(nkey, self._load_segment, hid, n)
+        return data
+
+    def _load_segment(self, hid, seq):
+        source = self.hls_source(hid)
+        txt = self.get_playlist(*source)
+        if txt is None:
+            return None
+        urls = hls.segment_urls(txt, pcs.PCS_URL)
+        if seq >= len(urls):
+            return None
+        with timed('hls_segment') as call:
+            req = self.client.session.get(urls[seq], timeout=HTTP_TIMEOUT)
+            call.failed = req.status_code != 200
+        if call.failed:
+            _logger.warning("segment %d of %s: HTTP %d" % (seq, source[0], req.status_code))
+            return None
+        data = req.content
+        bytes_total.inc(self.sharePath, 'upstream', amount=len(data))
+        _blockcache.put((self.sharePath, HLS_PREFIX, hid, seq), data)
+        return data
+
+    def warm_members(self, coll, members, take):
+        """warmer hook: download links and playlists of the new videos of a folder
+
+        Runs on the warmer's worker, one upstream call at a time, each
+        after take() allows it.
+        """
+        added = time.time() - WARM_RECENT
+        videos = [m.file_info['path'] for m in members
+                  if isinstance(m, BdyunStreamFile) and m.file_info['server_ctime'] >= added]
+        self._resolve_links(coll.rpath, [p for p in videos if self.links.get(p.encode('utf-8')) is None],
+                            take)
+        for path in videos:
+            if (path, VIDEO_TYPE) not in self.playlists:
+                take()
+                self.get_playlist(path)
+
+    def prefetch_links(self, path):
+        """resolve download links of the files in folder `path` in background"""
+        now = time.time()
+        with self.link_lock:
+            last = self.link_dirs.pop(path, 0)
+            if now - last < LINK_TTL/2:
+                self.link_dirs[path] = last
+                return
+            self.link_dirs[path] = now
+            while len(self.link_dirs) > MAX_LINK_DIRS:
+                self.link_dirs.popitem(last=False)
+        _engine.meta.submit(('links', id(self), path), self._prefetch_links, path)
+
+    def _prefetch_links(self, path):
+        ent = self.dircache.peek(path)
+        if ent is None:
+            return
+        paths = [item['path'] for item in ent[1].items
+                 if not item['isdir'] and self.links.get(item['path'].encode('utf-8')) is None]
+        self._resolve_links(path, paths)
+
+    def _resolve_links(self, folder, paths, take=None):
+        """cache the download links of paths (files of folder)
+
+        Without take the calls run in parallel on the meta lane, with take
+        one at a time on this thread, each after take().
+        """
+        paths = paths[:MAX_PREFETCH_LINKS]
+        if not paths:
+            return
+        batches = [paths[i:i+LINK_BATCH] for i in range(0, len(paths), LINK_BATCH)]
+        def get_metas(batch):
+            if take is not None:
+                take()
+            return self.client.get_metas(batch)
+        def resolve(info):
+            if take is not None:
+                take()
+            url = self.client.get_dlink_location(info['dlink'])
+            self.links.put(info['path'].encode('utf-8'), url, link_expires(url))
+        run = map if take is not None else self.client.map
+        infos = []
+        for metas in run(get_metas, batches):
+            if not metas or metas.get('errno', -1) != 0:
+                _logger.warning("filemetas failed in %s: %s" % (folder, metas))
+                continue
+            infos.extend(info for info in metas.get('info', []) if info.get('dlink'))
+        run(resolve, infos)
+        _logger.info("resolved %d download links in %s" % (len(infos), folder))
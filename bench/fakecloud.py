@@ -0,0 +1,395 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-in for the Baidu PCS and Ndrive endpoints used by the providers
+
+Serves one generated tree to both clouds:
+
+    /dir<N>/file<i>.bin     N small files for each N in --dirs
+    /media/video<i>.mkv     --files large files of --file-size MB
+
+Baidu: /pan/api/list, /pan/api/search, /pan/api/categorylist (video and
+other), /pan/api/filemetas, /pcs/file?method=download|streaming,
+/pcsd/dlink (dlink redirects), /cdn/<path> (content with Range),
+/hls/<n>.ts (playlist segments), and for writes /pan/api/create,
+/pan/api/filemanager (delete, move) and /pcsc/file?method=upload|
+rapidupload|createsuperfile. Uploaded files are kept in memory.
+Ndrive: /nd/GetRegisterUserInfo.ndrive, /nd/GetList.ndrive,
+/nd/DoSearch.ndrive and /nd/<path>.
+
+Every request waits --latency ms and bodies are sent at most at --bandwidth
+KB/s per connection. File content is a repeated pseudo-random pattern, see
+content().
+
+    $ python bench/fakecloud.py --port 8090 --latency 50 --dirs 10,1000
+"""
+import argparse
+import cgi
+import hashlib
+import json
+import random
+import re
+import sys
+import time
+import urllib
+import urlparse
+import threading
+import BaseHTTPServer
+from StringIO import StringIO
+import SocketServer
+
+PATTERN_SIZE = 1024*1024
+SMALL_FILE_SIZE = 64*1024
+HLS_SEGMENT_SIZE = 256*1024
+HLS_SEGMENTS = 10
+MTIME = 1500000000
+SEND_CHUNK = 64*1024
+
+_rnd = random.Random(0)
+PATTERN = ''.join(chr(_rnd.randint(0, 255)) for i in xrange(PATTERN_SIZE))
+
+
+def content(start, end):
+    """bytes start..end (inclusive) of every generated file"""
+    out = []
+    pos = start
+    while pos <= end:
+        off = pos % PATTERN_SIZE
+        n = min(PATTERN_SIZE - off, end - pos + 1)
+        out.append(PATTERN[off:off+n])
+        pos += n
+    return ''.join(out)
+
+
+class Tree(object):
+    """generated directory tree, path -> (isdir, size)"""
+    def __init__(self, dirs, files, file_size):
+        self.children = {'/': []}
+        self.nodes = {'/': (True, 0)}
+        self.data = {}      # path -> content of uploaded files
+        self.blobs = {}     # md5 -> uploaded tmpfile part
+        self.lock = threading.Lock()
+        for n in dirs:
+            d = self._add('/', 'dir%d' % n, True, 0)
+            for i in range(n):
+                self._add(d, 'file%05d.bin' % i, False, SMALL_FILE_SIZE)
+        d = self._add('/', 'media', True, 0)
+        for i in range(files):
+            self._add(d, 'video%d.mkv' % i, False, file_size)
+
+    def _add(self, parent, name, isdir, size):
+        path = parent.rstrip('/') + '/' + name
+        self.nodes[path] = (isdir, size)
+        self.children[parent].append(path)
+        if isdir:
+            self.children[path] = []
+        return path
+
+    def put_file(self, path, data):
+        with self.lock:
+            if path in self.nodes:
+                self._remove(path)
+            self._add(path.rsplit('/', 1)[0] or '/', path.rsplit('/', 1)[-1], False, len(data))
+            self.data[path] = data
+
+    def mkdir(self, path):
+        with self.lock:
+            return self._add(path.rsplit('/', 1)[0] or '/', path.rsplit('/', 1)[-1], True, 0)
+
+    def remove(self, path):
+        with self.lock:
+            if path not in self.nodes:
+                return False
+            self._remove(path)
+            return True
+
+    def move(self, path, dest):
+        with self.lock:
+            if path not in self.nodes or (dest.rsplit('/', 1)[0] or '/') not in self.children:
+                return False
+            if dest in self.nodes:
+                self._remove(dest)
+            self._move(path, dest)
+            return True
+
+    def _remove(self, path):
+        for child in list(self.children.get(path, [])):
+            self._remove(child)
+        self.children.pop(path, None)
+        self.children[path.rsplit('/', 1)[0] or '/'].remove(path)
+        del self.nodes[path]
+        self.data.pop(path, None)
+
+    def _move(self, path, dest):
+        isdir, size = self.nodes[path]
+        self._add(dest.rsplit('/', 1)[0] or '/', dest.rsplit('/', 1)[-1], isdir, size)
+        if path in self.data:
+            self.data[dest] = self.data[path]
+        for child in list(self.children.get(path, [])):
+            self._move(child, dest + '/' + child.rsplit('/', 1)[-1])
+        self._remove(path)
+
+    def file_content(self, path, start, end):
+        if path in self.data:
+            return self.data[path][start:end+1]
+        return content(start, end)
+
+    def find(self, key='', video=None):
+        """files whose name contains key, only videos or only non-videos"""
+        found = []
+        for path in sorted(self.nodes):
+            isdir, size = self.nodes[path]
+            if isdir or key not in path.rsplit('/', 1)[-1]:
+                continue
+            if video is None or video == path.endswith('.mkv'):
+                found.append(path)
+        return found
+
+    def bdyun_item(self, path):
+        isdir, size = self.nodes[path]
+        return {'path': path, 'server_filename': path.rsplit('/', 1)[-1],
+                'isdir': int(isdir), 'size': size, 'fs_id': abs(hash(path)),
+                'md5': '%032x' % abs(hash(path)),
+                'local_mtime': MTIME, 'local_ctime': MTIME,
+                'server_mtime': MTIME, 'server_ctime': MTIME}
+
+    def ndrive_item(self, path):
+        isdir, size = self.nodes[path]
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%S+00:00', time.gmtime(MTIME))
+        return {'href': path + ('/' if isdir else ''),
+                'resourcetype': 'collection' if isdir else 'property',
+                'getcontentlength': size, 'resourceno': abs(hash(path)),
+                'getlastmodified': stamp, 'creationdate': stamp}
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def _handle(self, method):
+        cfg = self.server.cfg
+        if cfg.latency:
+            time.sleep(cfg.latency / 1000.0)
+        url = urlparse.urlparse(self.path)
+        query = dict(urlparse.parse_qsl(url.query, keep_blank_values=True))
+        upload = None
+        if method == 'POST':
+            body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            ctype = self.headers.get('Content-Type', '')
+            if ctype.startswith('multipart/form-data'):
+                form = cgi.FieldStorage(fp=StringIO(body), headers=self.headers,
+                                        environ={'REQUEST_METHOD': 'POST', 'CONTENT_TYPE': ctype})
+                upload = form['file'].value
+            else:
+                query.update(urlparse.parse_qsl(body, keep_blank_values=True))
+        path = urllib.unquote(url.path)
+        tree = self.server.tree
+        if path == '/pan/api/list':
+            items = tree.children.get(query.get('dir'))
+            if items is None:
+                return self._json({'errno': -9, 'list': []})
+            num = int(query.get('num', 100))
+            first = (int(query.get('page', 1)) - 1) * num
+            return self._json({'errno': 0, 'list': [tree.bdyun_item(p) for p in items[first:first+num]]})
+        if path == '/pan/api/search':
+            found = tree.find(query.get('key', ''))
+            num = int(query.get('num', 100))
+            first = (int(query.get('page', 1)) - 1) * num
+            return self._json({'errno': 0, 'list': [tree.bdyun_item(p) for p in found[first:first+num]]})
+        if path == '/pan/api/categorylist':
+            found = tree.find(video=query.get('category') == '1')
+            first = (int(query.get('page', 1)) - 1) * 100
+            return self._json({'errno': 0, 'info': [tree.bdyun_item(p) for p in found[first:first+100]]})
+        if path == '/pan/api/create':
+            p = tree.mkdir(query['path'])
+            return self._json(dict(tree.bdyun_item(p), errno=0, ctime=MTIME, mtime=MTIME))
+        if path == '/pan/api/filemanager':
+            filelist = json.loads(query.get('filelist', '[]'))
+            if query.get('opera') == 'delete':
+                ok = all([tree.remove(p.encode('utf-8')) for p in filelist])
+            else:
+                ok = all([tree.move(f['path'].encode('utf-8'),
+                                    (f['dest'].rstrip('/') + '/' + f['newname']).encode('utf-8'))
+                          for f in filelist])
+            return self._json({'errno': 0 if ok else 12})
+        if path == '/pcsc/file':
+            return self._store(query, upload)
+        if path == '/pan/api/filemetas':
+            info = [{'path': p, 'dlink': self._base() + '/pcsd/dlink?path=' + urllib.quote(p.encode('utf-8'))}
+                    for p in json.loads(query.get('target', '[]')) if p.encode('utf-8') in tree.nodes]
+            return self._json({'errno': 0, 'info': info})
+        if path in ('/pcs/file', '/pcsd/dlink'):
+            fpath = query.get('path', '')
+            if query.get('method') == 'streaming':
+                return self._playlist(fpath)
+            return self._redirect('/cdn' + urllib.quote(fpath) + '?expires=8h')
+        if path.startswith('/cdn/'):
+            return self._file(path[4:])
+        m = re.match(r'/hls/(\d+)\.ts$', path)
+        if m:
+            first = int(m.group(1)) * HLS_SEGMENT_SIZE
+            return self._send(200, 'video/MP2T', content(first, first + HLS_SEGMENT_SIZE - 1))
+        if path == '/nd/GetRegisterUserInfo.ndrive':
+            return self._json({'message': 'success', 'resultvalue': {'useridx': 1}})
+        if path == '/nd/GetList.ndrive':
+            items = tree.children.get(query.get('orgresource', '').rstrip('/') or '/', [])
+            first = int(query.get('startnum', 0))
+            num = int(query.get('pagingrow', 1000))
+            return self._json({'message': 'success',
+                               'resultvalue': [tree.ndrive_item(p) for p in items[first:first+num]]})
+        if path == '/nd/DoSearch.ndrive':
+            filetype = query.get('filetype', '0')
+            found = tree.find(query.get('filename', ''), {'0': None, '3': True}.get(filetype, False))
+            first = int(query.get('startnum', 0))
+            num = int(query.get('pagingrow', 100))
+            return self._json({'message': 'success',
+                               'resultvalue': [tree.ndrive_item(p) for p in found[first:first+num]]})
+        if path.startswith('/nd/'):
+            return self._file(path[3:])
+        self._send(404, 'text/plain', 'not found')
+
+    def _store(self, query, upload):
+        tree = self.server.tree
+        method = query.get('method')
+        if method == 'upload' and query.get('type') == 'tmpfile':
+            md5 = hashlib.md5(upload).hexdigest()
+            tree.blobs[md5] = upload
+            return self._json({'md5': md5})
+        if method == 'upload':
+            fpath = query['dir'].rstrip('/') + '/' + query['filename']
+            data = upload
+        elif method == 'createsuperfile':
+            fpath = query['path']
+            data = ''.join(tree.blobs[md5] for md5 in json.loads(query['param'])['block_list'])
+        elif method == 'rapidupload':
+            fpath = query['path']
+            data = [d for d in tree.data.values() if hashlib.md5(d).hexdigest() == query['content-md5']]
+            if not data:
+                return self._send(404, 'application/json', json.dumps({'error_code': 31079}))
+            data = data[0]
+        else:
+            return self._send(400, 'application/json', json.dumps({'error_code': 31023}))
+        tree.put_file(fpath, data)
+        return self._json({'path': fpath, 'size': len(data), 'md5': hashlib.md5(data).hexdigest(),
+                           'fs_id': abs(hash(fpath)), 'ctime': int(time.time()), 'mtime': int(time.time())})
+
+    def _base(self):
+        return 'http://%s:%d' % self.server.server_address
+
+    def _json(self, obj):
+        self._send(200, 'application/json', json.dumps(obj))
+
+    def _redirect(self, location):
+        self.send_response(302)
+        self.send_header('Location', self._base() + location)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def _playlist(self, fpath):
+        lines = ['#EXTM3U', '#EXT-X-TARGETDURATION:10']
+        for i in range(HLS_SEGMENTS):
+            lines += ['#EXTINF:10,', self._base() + '/hls/%d.ts?path=%s' % (i, urllib.quote(fpath))]
+        lines.append('#EXT-X-ENDLIST')
+        self._send(200, 'application/vnd.apple.mpegurl', '\n'.join(lines) + '\n')
+
+    def _file(self, fpath):
+        node = self.server.tree.nodes.get(fpath.rstrip('/'))
+        if node is None or node[0]:
+            return self._send(404, 'text/plain', 'not found')
+        size = node[1]
+        start, end = 0, size - 1
+        m = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if m and not self.server.cfg.ignore_range:
+            start = int(m.group(1))
+            if m.group(2):
+                end = min(int(m.group(2)), size - 1)
+            if start >= size:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                return self.end_headers()
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+        self._write_throttled(fpath.rstrip('/'), start, end)
+
+    def _send(self, status, ctype, body):
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self._write(body)
+
+    def _write_throttled(self, fpath, start, end):
+        rate = self.server.cfg.bandwidth * 1024
+        began = time.time()
+        sent = 0
+        pos = start
+        try:
+            while pos <= end:
+                chunk = self.server.tree.file_content(fpath, pos, min(pos + SEND_CHUNK, end + 1) - 1)
+                self.wfile.write(chunk)
+                pos += len(chunk)
+                sent += len(chunk)
+                if rate:
+                    ahead = sent / float(rate) - (time.time() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except IOError:     # client went away
+            self.close_connection = 1
+
+    def _write(self, body):
+        try:
+            self.wfile.write(body)
+        except IOError:
+            self.close_connection = 1
+
+
+class FakeCloudServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, cfg):
+        BaseHTTPServer.HTTPServer.__init__(self, (cfg.host, cfg.port), Handler)
+        self.cfg = cfg
+        self.tree = Tree(cfg.dirs, cfg.files, cfg.file_size*1024*1024)
+
+
+def int_list(s):
+    return [int(x) for x in s.split(',') if x]
+
+
+def make_parser():
+    parser = argparse.ArgumentParser(description="fake Baidu PCS / Ndrive server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8090)
+    parser.add_argument('--latency', type=float, default=0, help="ms added to every request")
+    parser.add_argument('--bandwidth', type=int, default=0, help="KB/s per connection (0 = unlimited)")
+    parser.add_argument('--dirs', type=int_list, default=[10, 100, 1000], help="folder sizes, e.g. 10,100,1000")
+    parser.add_argument('--files', type=int, default=4, help="number of large files in /media")
+    parser.add_argument('--file-size', type=int, default=256, help="MB per large file")
+    parser.add_argument('--ignore-range', action='store_true', help="answer Range requests with 200")
+    return parser
+
+
+if __name__ == '__main__':
+    cfg = make_parser().parse_args()
+    server = FakeCloudServer(cfg)
+    print "ready http://%s:%d" % server.server_address
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
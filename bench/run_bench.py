@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark BdyunProvider and NdriveProvider against bench/fakecloud.py
+
+Starts the stand-in server in a subprocess, points bcloud and ndrive at it,
+serves both providers through wsgidav on a local port and reports
+
+    propfind_<N>_cold/warm  PROPFIND Depth:1 latency of a folder of N (ms)
+    get_mbps                GET throughput of one large file (MB/s)
+    seek_p50/p90            latency of 64KB Range GETs at random offsets (ms)
+    mem_per_stream          RSS growth per open GET stream (KB), caches included
+
+for each share. With --save the results are written as json, and with
+--compare a previous result file is used as baseline: the run fails when a
+value is more than --tolerance worse.
+
+    $ python bench/run_bench.py --latency 50 --save base.json
+    $ python bench/run_bench.py --latency 50 --compare base.json
+"""
+import os
+import sys
+import json
+import random
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+import requests
+from wsgiref.simple_server import WSGIServer, WSGIRequestHandler, ServerHandler, make_server
+import SocketServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import fakecloud
+
+SEEKS = 20
+SEEK_SIZE = 64*1024
+STREAM_READ = 4*1024*1024
+WARM_RUNS = 5
+
+PROPFIND_BODY = ('<?xml version="1.0" encoding="utf-8"?>'
+                 '<propfind xmlns="DAV:"><allprop/></propfind>')
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def rss_kb():
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    return 0
+
+
+def start_fake(args):
+    port = free_port()
+    cmd = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fakecloud.py'),
+           '--port', str(port), '--latency', str(args.latency), '--bandwidth', str(args.bandwidth),
+           '--dirs', ','.join(map(str, args.dirs)), '--files', str(args.files),
+           '--file-size', str(args.file_size)]
+    if args.ignore_range:
+        cmd.append('--ignore-range')
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    line = proc.stdout.readline()
+    if not line.startswith('ready'):
+        raise RuntimeError("fakecloud failed to start")
+    return proc, 'http://127.0.0.1:%d' % port
+
+
+def point_clients_at(base):
+    """redirect bcloud and ndrive to the stand-in server"""
+    from bcloud import pcs
+    import ndrive.client
+    from ndrive.urls import ndrive_urls
+    pcs.PAN_URL = base + '/pan/'
+    pcs.PAN_API_URL = base + '/pan/api/'
+    pcs.PCS_URL = base + '/pcs/'
+    pcs.PCS_URL_D = base + '/pcsd/'
+    pcs.PCS_URL_C = base + '/pcsc/'
+    for key, url in ndrive_urls.items():
+        for host in ('http://ndrive2.naver.com', 'http://ndrive.naver.com'):
+            if url.startswith(host):
+                ndrive_urls[key] = base + '/nd' + url[len(host):]
+    ndrive.client.getCookie = lambda user_id, password: {'NID_AUT': 'bench', 'NID_SES': 'bench'}
+
+
+class ThreadingWSGIServer(SocketServer.ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass    # clients close streams early; app errors go through wsgidav
+
+
+class StreamHandler(ServerHandler):
+    def start_response(self, status, headers, exc_info=None):
+        # wsgidav adds `Connection: close` to responses without Content-Length
+        # (streamed PROPFIND), a hop-by-hop header wsgiref refuses
+        headers = [(k, v) for k, v in headers if k.lower() != 'connection']
+        return ServerHandler.start_response(self, status, headers, exc_info)
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def get_stderr(self):
+        return open(os.devnull, 'w')    # tracebacks of closed streams
+
+    def handle(self):
+        """WSGIRequestHandler.handle() with StreamHandler"""
+        self.raw_requestline = self.rfile.readline(65537)
+        if len(self.raw_requestline) > 65536:
+            return self.send_error(414)
+        if not self.parse_request():
+            return
+        handler = StreamHandler(self.rfile, self.wfile, self.get_stderr(), self.get_environ())
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+
+
+def start_dav(args):
+    from wsgidav.wsgidav_app import DEFAULT_CONFIG, WsgiDAVApp
+    from bdyun_dav_provider import BdyunProvider
+    from ndrive_dav_provider import NdriveProvider
+    from metrics import MetricsMiddleware
+    from propfind import PropfindStreamer
+    cfgpath = os.path.join(tempfile.mkdtemp(), 'bdyun.json')
+    with open(cfgpath, 'w') as f:
+        json.dump({'cookie': {'BDUSS': 'bench', 'cflag': '65535:1'},
+                   'tokens': {'token': 'bench', 'bdstoken': 'bench'}}, f)
+    config = DEFAULT_CONFIG.copy()
+    config.update({
+        'provider_mapping': {
+            '/bdyun': BdyunProvider('bench', 'bench', cfgpath),
+            '/ndrive': NdriveProvider('bench', 'bench'),
+        },
+        'user_mapping': {},
+        'verbose': 0,
+        'propsmanager': True,
+        'dir_browser': {'enable': False},
+        'block_size': 262143,
+        'middleware_stack': [PropfindStreamer, MetricsMiddleware] + DEFAULT_CONFIG['middleware_stack'],
+    })
+    port = free_port()
+    httpd = make_server('127.0.0.1', port, WsgiDAVApp(config),
+                        server_class=ThreadingWSGIServer, handler_class=QuietHandler)
+    t = threading.Thread(target=httpd.serve_forever)
+    t.daemon = True
+    t.start()
+    return 'http://127.0.0.1:%d' % port
+
+
+def propfind_ms(url):
+    began = time.time()
+    r = requests.request('PROPFIND', url, data=PROPFIND_BODY, headers={'Depth': '1'})
+    r.raise_for_status()
+    return (time.time() - began) * 1000
+
+
+def median(values, q=0.5):
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def bench_share(dav, share, args):
+    res = {}
+    for n in args.dirs:
+        url = '%s/%s/dir%d/' % (dav, share, n)
+        res['propfind_%d_cold' % n] = propfind_ms(url)
+        res['propfind_%d_warm' % n] = median([propfind_ms(url) for i in range(WARM_RUNS)])
+
+    size = args.file_size*1024*1024
+    began = time.time()
+    r = requests.get('%s/%s/media/video0.mkv' % (dav, share), stream=True)
+    got = 0
+    for chunk in r.iter_content(1024*1024):
+        if got == 0 and chunk[:1024] != fakecloud.content(0, 1023):
+            raise AssertionError("wrong content from %s" % share)
+        got += len(chunk)
+    if got != size:
+        raise AssertionError("short GET from %s: %d of %d" % (share, got, size))
+    res['get_mbps'] = size / (1024*1024.0) / (time.time() - began)
+
+    rnd = random.Random(1)
+    lat = []
+    for i in range(SEEKS):
+        pos = rnd.randrange(0, size - SEEK_SIZE)
+        began = time.time()
+        r = requests.get('%s/%s/media/video1.mkv' % (dav, share),
+                         headers={'Range': 'bytes=%d-%d' % (pos, pos + SEEK_SIZE - 1)})
+        if r.content != fakecloud.content(pos, pos + SEEK_SIZE - 1):
+            raise AssertionError("wrong range from %s at %d" % (share, pos))
+        lat.append((time.time() - began) * 1000)
+    res['seek_p50'] = median(lat)
+    res['seek_p90'] = median(lat, 0.9)
+
+    before = rss_kb()
+    streams = []
+    for i in range(args.streams):
+        video = 2 + i % max(args.files - 2, 1)
+        r = requests.get('%s/%s/media/video%d.mkv' % (dav, share, video), stream=True,
+                         headers={'Range': 'bytes=%d-' % (i * STREAM_READ)})
+        r.raw.read(STREAM_READ)
+        streams.append(r)
+    res['mem_per_stream'] = (rss_kb() - before) / float(args.streams)
+    for r in streams:
+        r.close()
+    return res
+
+
+# larger is better for these, smaller for everything else
+HIGHER_IS_BETTER = ('get_mbps',)
+
+def compare(results, baseline, tolerance):
+    failed = []
+    for share, values in sorted(results.items()):
+        for key, value in sorted(values.items()):
+            base = baseline.get(share, {}).get(key)
+            if not base:
+                continue
+            if key in HIGHER_IS_BETTER:
+                worse = value < base * (1 - tolerance)
+            else:
+                worse = value > base * (1 + tolerance)
+            if worse:
+                failed.append("%s %s: %.1f (baseline %.1f)" % (share, key, value, base))
+    return failed
+
+
+def main():
+    parser = fakecloud.make_parser()
+    parser.description = "benchmark the DAV providers against fakecloud"
+    parser.add_argument('--streams', type=int, default=8, help="open streams for mem_per_stream")
+    parser.add_argument('--shares', default='bdyun,ndrive')
+    parser.add_argument('--save', help="write results to this json file")
+    parser.add_argument('--compare', help="baseline json file from --save")
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--metrics', help="write the final /metrics page to this file")
+    args = parser.parse_args()
+    if args.files < 3:
+        parser.error("--files must be 3 or more")
+
+    proc, base = start_fake(args)
+    try:
+        point_clients_at(base)
+        dav = start_dav(args)
+        results = {}
+        for share in args.shares.split(','):
+            results[share] = bench_share(dav, share, args)
+            for key, value in sorted(results[share].items()):
+                print "%-8s %-22s %10.1f" % (share, key, value)
+        if args.metrics:
+            with open(args.metrics, 'w') as f:
+                f.write(requests.get(dav + '/metrics').content)
+    finally:
+        proc.terminate()
+
+    sys.stdout.flush()
+    status = 0
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            failed = compare(results, json.load(f), args.tolerance)
+        for line in failed:
+            print "REGRESSION", line
+        status = 1 if failed else 0
+    sys.stdout.flush()
+    os._exit(status)    # do not wait for the daemon server threads
+
+if __name__ == '__main__':
+    main()
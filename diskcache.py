@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Persistent block cache for remote file content
+
+Each cached file is a sparse local file holding the blocks fetched so far.
+`index.json` keeps the remote stamp (size, mtime) of every file, the list of
+present blocks and the last access time used for LRU eviction.
+
+The index is only trusted for files not written since it was saved: on
+load, a file that is missing, has the wrong size or is newer than the
+index is dropped, and files the index does not know are deleted.
+"""
+import os
+import re
+import json
+import time
+import atexit
+import hashlib
+import threading
+from wsgidav.util import getModuleLogger
+from metrics import cache_events
+
+_logger = getModuleLogger(__name__)
+
+INDEX_NAME = "index.json"
+FILE_NAME = re.compile(r'[0-9a-f]{40}$')  # sha1 of the file key
+SAVE_INTERVAL = 60
+
+
+class DiskCache(object):
+    def __init__(self, cachedir, max_size, block_size):
+        self.cachedir = cachedir
+        self.max_size = max_size
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.used = 0
+        self.dirty = False
+        self.saved_at = time.time()
+        self.save_lock = threading.Lock()
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self._load()
+        atexit.register(self.save)
+
+    def _load(self):
+        """keep the index entries matching their files, delete the other files"""
+        try:
+            with open(os.path.join(self.cachedir, INDEX_NAME)) as f:
+                obj = json.load(f)
+        except (IOError, ValueError):
+            obj = {}
+        if obj and obj.get('block_size') != self.block_size:
+            _logger.info("block size changed, dropping disk cache")
+            obj = {}
+        saved_at = obj.get('saved_at', 0)
+        entries = obj.get('entries', {})
+        for fname in os.listdir(self.cachedir):
+            if not FILE_NAME.match(fname):
+                continue
+            ent = entries.get(fname)
+            st = os.stat(os.path.join(self.cachedir, fname))
+            # a file written after the save may hold blocks the index lacks,
+            # or be a new sparse file where the index lists old blocks
+            if ent is None or st.st_size != ent['stamp'][0] or st.st_mtime > saved_at:
+                self._unlink(fname)
+                continue
+            ent['blocks'] = set(ent['blocks'])
+            self.entries[fname] = ent
+            self.used += ent['bytes']
+        dropped = len(entries) - len(self.entries)
+        if dropped:
+            _logger.info("dropped %d unsaved files from disk cache" % dropped)
+
+    def save(self):
+        # save_lock keeps an older snapshot from replacing a newer one
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                entries = {}
+                for fname, ent in self.entries.items():
+                    ent = dict(ent)
+                    ent['blocks'] = sorted(ent['blocks'])
+                    entries[fname] = ent
+                self.dirty = False
+                self.saved_at = time.time()
+            path = os.path.join(self.cachedir, INDEX_NAME)
+            with open(path + ".tmp", 'w') as f:
+                json.dump({'block_size':self.block_size, 'saved_at':self.saved_at,
+                           'entries':entries}, f)
+            os.rename(path + ".tmp", path)
+
+    def _fname(self, fkey):
+        return hashlib.sha1(repr(fkey)).hexdigest()
+
+    def _unlink(self, fname):
+        try:
+            os.remove(os.path.join(self.cachedir, fname))
+        except OSError:
+            pass
+
+    def _lookup(self, fkey, stamp):
+        """return the fresh entry of a file, dropping a stale one"""
+        fname = self._fname(fkey)
+        ent = self.entries.get(fname)
+        if ent is None:
+            return fname, None
+        if ent['stamp'] != list(stamp):
+            self._drop(fname)
+            return fname, None
+        ent['atime'] = time.time()
+        return fname, ent
+
+    def _drop(self, fname):
+        ent = self.entries.pop(fname)
+        self.used -= ent['bytes']
+        self._unlink(fname)
+        self.dirty = True
+
+    def _evict(self):
+        lru = sorted(self.entries.items(), key=lambda x: x[1]['atime'])
+        for fname, ent in lru:
+            if self.used <= self.max_size:
+                break
+            self._drop(fname)
+            cache_events.inc('disk', 'evict')
+
+    def get_block(self, fkey, stamp, idx):
+        with self.lock:
+            fname, ent = self._lookup(fkey, stamp)
+            if ent is None or idx not in ent['blocks']:
+                cache_events.inc('disk', 'miss')
+                return None
+        cache_events.inc('disk', 'hit')
+        first = idx*self.block_size
+        try:
+            with open(os.path.join(self.cachedir, fname), 'rb') as f:
+                f.seek(first)
+                return f.read(self.block_size)
+        except (IOError, OSError) as e:
+            _logger.warning("disk cache read failed: %s" % e)
+            return None
+
+    def put_block(self, fkey, stamp, idx, data):
+        with self.lock:
+            fname, ent = self._lookup(fkey, stamp)
+            if ent is not None and idx in ent['blocks']:
+                return
+            path = os.path.join(self.cachedir, fname)
+            try:
+                if ent is None:
+                    with open(path, 'wb') as f:
+                        f.truncate(stamp[0])    # sparse
+                    ent = {'key':list(fkey), 'stamp':list(stamp), 'blocks':set(),
+                           'bytes':0, 'atime':time.time()}
+                    self.entries[fname] = ent
+                with open(path, 'r+b') as f:
+                    f.seek(idx*self.block_size)
+                    f.write(data)
+            except (IOError, OSError) as e:
+                _logger.warning("disk cache write failed: %s" % e)
+                return
+            ent['blocks'].add(idx)
+            ent['bytes'] += len(data)
+            self.used += len(data)
+            self.dirty = True
+            self._evict()
+        if time.time() - self.saved_at > SAVE_INTERVAL:
+            self.save()
+
+    def open(self, fkey, stamp):
+        """return a local file object if the whole file is cached, else None"""
+        with self.lock:
+            fname, ent = self._lookup(fkey, stamp)
+            if ent is None:
+                return None
+            nblocks = (stamp[0] + self.block_size - 1) // self.block_size
+            if len(ent['blocks']) < nblocks:
+                return None
+        try:
+            return open(os.path.join(self.cachedir, fname), 'rb')
+        except IOError:
+            return None
@@ -0,0 +1,237 @@
+# -*- coding: utf-8 -*-
+"""
+Upstream I/O engine
+
+Upstream work of the providers (listings, metadata, link resolution, block
+and segment downloads) runs on a few shared lanes of worker threads instead
+of threads owned by each stream or client. The `meta` lane serves listing
+and metadata calls and the `data` lane content transfers, so slow downloads
+cannot hold up PROPFIND.
+
+Synchronous callers submit a job and wait for its Task. A job submitted
+with a key already in flight joins the running Task instead of starting a
+second one, and jobs a client is waiting for (URGENT) are served before
+prefetches (BACKGROUND).
+
+`Engine.flights` coalesces calls that must run on the caller's own thread
+(e.g. a listing that fans its pages out on the meta lane): the first caller
+of a key runs it and concurrent callers of the same key wait for its result.
+A worker of the meta lane does not wait for a caller outside the lane: that
+caller may need free meta workers for its fan-out, so the worker runs the
+call itself.
+"""
+import itertools
+import threading
+import Queue
+from wsgidav.util import getModuleLogger
+from metrics import coalesced
+
+_logger = getModuleLogger(__name__)
+
+URGENT = 0
+BACKGROUND = 1
+
+
+class Task(object):
+    """one job on a lane; wait() returns its result or raises its error"""
+    def __init__(self, key, func, args, priority):
+        self.key = key
+        self.func = func
+        self.args = args
+        self.priority = priority
+        self.started = False
+        self.cancelled = False
+        self.thread = None  # caller running a Flights call
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+    def run(self):
+        """call func, finish() wakes the waiters"""
+        if not self.cancelled:
+            try:
+                self.result = self.func(*self.args)
+            except Exception as e:
+                self.error = e
+
+    def finish(self):
+        self.done.set()
+
+    def wait(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class Lane(object):
+    """daemon threads serving one priority queue
+
+    The lane runs up to `workers` threads plus the slots reserved by open
+    streams (reserve/release), never more than `max_workers`. Threads are
+    started on demand, so these may still be changed after import (e.g.
+    from wsgidav.conf), and a thread above the limit ends after its job.
+    """
+    def __init__(self, name, workers, max_workers=None):
+        self.name = name
+        self.workers = workers
+        self.max_workers = max_workers or workers
+        self.reserved = 0
+        self.queue = Queue.PriorityQueue()
+        self.seq = itertools.count()
+        self.pending = {}   # key -> Task not finished yet
+        self.threads = []
+        self.idle = 0
+        self.lock = threading.Lock()
+
+    def submit(self, key, func, *args, **kwargs):
+        """queue func(*args) and return its Task
+
+        kwargs: priority (default BACKGROUND)
+        """
+        priority = kwargs.get('priority', BACKGROUND)
+        with self.lock:
+            task = self.pending.get(key) if key is not None else None
+            if task is None:
+                task = Task(key, func, args, priority)
+                if key is not None:
+                    self.pending[key] = task
+            else:
+                coalesced.inc(self.name)
+                if task.started or priority >= task.priority:
+                    return task
+            self._put(task, priority)
+        return task
+
+    def reserve(self, n):
+        """raise the thread limit by n for a stream's transfers"""
+        with self.lock:
+            self.reserved += n
+
+    def release(self, n):
+        with self.lock:
+            self.reserved -= n
+
+    def limit(self):
+        return min(self.workers + self.reserved, max(self.workers, self.max_workers))
+
+    def bump(self, task):
+        """serve a queued task before background jobs"""
+        with self.lock:
+            if not task.started and task.priority > URGENT:
+                self._put(task, URGENT)
+
+    def _put(self, task, priority):
+        task.priority = priority
+        self.queue.put((priority, next(self.seq), task))
+        if self.idle == 0 and len(self.threads) < self.limit():
+            t = threading.Thread(target=self._run, name="%s-%d" % (self.name, len(self.threads)))
+            t.daemon = True
+            self.threads.append(t)
+            t.start()
+
+    def call(self, key, func, *args):
+        """run func(*args) on the lane and wait for the result
+
+        Called from a worker of this lane, func runs inline so that a
+        job never waits for a free worker of its own lane; a running job
+        of the same key is joined and a queued one taken over.
+        """
+        if not self.inline():
+            return self.submit(key, func, *args, priority=URGENT).wait()
+        if key is None:
+            return func(*args)
+        with self.lock:
+            task = self.pending.get(key)
+            run = task is None or not task.started
+            if task is None:
+                task = self.pending[key] = Task(key, func, args, URGENT)
+            elif not run:
+                coalesced.inc(self.name)
+            task.started = True
+        if run:
+            self._execute(task)
+        return task.wait()
+
+    def inline(self):
+        """whether call() and map() run inline, i.e. on a worker of this lane"""
+        return threading.current_thread() in self.threads
+
+    def map(self, func, seq):
+        """parallel map over the lane (a drop-in for ThreadPool.map)"""
+        if self.inline():
+            return [func(x) for x in seq]
+        tasks = [self.submit(None, func, x, priority=URGENT) for x in seq]
+        return [task.wait() for task in tasks]
+
+    def _run(self):
+        me = threading.current_thread()
+        while True:
+            with self.lock:
+                self.idle += 1
+            _, _, task = self.queue.get()
+            with self.lock:
+                self.idle -= 1
+                if task.started:    # queued again by bump()
+                    continue
+                task.started = True
+            self._execute(task)
+            with self.lock:
+                if len(self.threads) > self.limit():
+                    self.threads.remove(me)
+                    return
+
+    def _execute(self, task):
+        task.run()
+        if task.error is not None and task.priority == BACKGROUND:
+            _logger.warning("%s job %s failed: %s" % (self.name, task.key, task.error))
+        # free the key before waking the waiters, so that a job submitted
+        # right after wait() returns is not joined to this finished one
+        if task.key is not None:
+            with self.lock:
+                if self.pending.get(task.key) is task:
+                    del self.pending[task.key]
+        task.finish()
+
+
+class Flights(object):
+    """single-flight calls on the caller's thread
+
+    A worker of `lane` only joins a call running on another worker of it,
+    since a call from outside may wait for the lane itself.
+    """
+    def __init__(self, lane=None):
+        self.lane = lane
+        self.pending = {}   # key -> Task running
+        self.lock = threading.Lock()
+
+    def call(self, key, func, *args):
+        """run func(*args), or wait for the result of a concurrent call of key"""
+        me = threading.current_thread()
+        with self.lock:
+            task = self.pending.get(key)
+            leader = task is None
+            if leader:
+                task = self.pending[key] = Task(key, func, args, URGENT)
+                task.started = True
+                task.thread = me
+            elif self.lane is not None and me in self.lane.threads \
+                    and task.thread not in self.lane.threads:
+                return func(*args)
+            else:
+                coalesced.inc('flights')
+        if leader:
+            try:
+                task.run()
+            finally:
+                with self.lock:
+                    del self.pending[key]
+                task.finish()
+        return task.wait()
+
+
+class Engine(object):
+    def __init__(self, meta_workers, data_workers, data_max_workers=None):
+        self.meta = Lane('meta', meta_workers)
+        self.data = Lane('data', data_workers, data_max_workers)
+        self.flights = Flights(self.meta)
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+HLS (m3u8) playlist helpers
+"""
+import urllib
+import urlparse
+
+
+def _is_uri(line):
+    return line.strip() and not line.startswith('#')
+
+
+def segment_urls(text, base):
+    """absolute urls of the media segments of a playlist"""
+    return [urlparse.urljoin(base, line.strip()) for line in text.splitlines() if _is_uri(line)]
+
+
+def master_playlist(variants):
+    """master playlist of (uri, bandwidth, resolution) variants"""
+    lines = ['#EXTM3U']
+    for uri, bandwidth, resolution in variants:
+        lines.append('#EXT-X-STREAM-INF:BANDWIDTH=%d,RESOLUTION=%s' % (bandwidth, resolution))
+        lines.append(urllib.quote(uri))
+    return '\n'.join(lines) + '\n'
+
+
+def rewrite(text, prefix):
+    """playlist with the n-th segment url replaced by prefix/n.ts"""
+    out = []
+    n = 0
+    for line in text.splitlines():
+        if _is_uri(line):
+            line = '%s/%d.ts' % (prefix, n)
+            n += 1
+        out.append(line)
+    return '\n'.join(out) + '\n'
@@ -0,0 +1,191 @@
+# -*- coding: utf-8 -*-
+"""
+Directory metadata cache
+
+One cache per share, bounded by the number of directories and by the total
+number of listed entries. An entry older than `ttl` is still returned for up
+to `stale` more seconds while a background refresh fetches a new listing.
+
+With a MetaStore, listings are also written to a sqlite file together with
+their fetch time and read back lazily on a cache miss after a restart.
+Rows past ttl+stale are pruned from the file.
+"""
+import time
+import json
+import atexit
+import sqlite3
+import threading
+from collections import OrderedDict
+from util import _engine
+from metrics import cache_events
+
+
+COMMIT_BATCH = 50       # writes per sqlite commit
+COMMIT_INTERVAL = 5     # max. seconds a write waits for its commit
+PRUNE_INTERVAL = 60*60  # seconds between removals of expired rows
+
+
+class MetaStore(object):
+    """sqlite snapshot of cached listings (raw listing items as json)
+
+    Writes are committed in batches of COMMIT_BATCH, or with the first write
+    after COMMIT_INTERVAL seconds. Once the owning MetaCache has called
+    expire(), rows older than its ttl+stale are removed then and every
+    PRUNE_INTERVAL seconds.
+    """
+    def __init__(self, path):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("CREATE TABLE IF NOT EXISTS listing"
+                        " (key TEXT PRIMARY KEY, fetched_at REAL, items TEXT)")
+        self.db.commit()
+        self.max_age = None
+        self.writes = 0
+        self.committed_at = time.time()
+        self.pruned_at = 0
+        atexit.register(self.close)
+
+    def load(self, key):
+        with self.lock:
+            row = self.db.execute("SELECT fetched_at, items FROM listing WHERE key=?",
+                                  (key.decode('utf-8'),)).fetchone()
+        if row is None:
+            return None
+        return row[0], json.loads(row[1])
+
+    def save(self, key, fetched_at, items):
+        data = json.dumps(items)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO listing VALUES (?, ?, ?)",
+                            (key.decode('utf-8'), fetched_at, data))
+            self._written()
+
+    def delete(self, prefix):
+        prefix = prefix.rstrip('/').decode('utf-8')
+        with self.lock:
+            self.db.execute("DELETE FROM listing WHERE key=? OR key=? OR substr(key, 1, ?)=?",
+                            (prefix, prefix + u'/', len(prefix)+1, prefix + u'/'))
+            self._written()
+
+    def expire(self, max_age):
+        """remove rows older than max_age seconds, now and from time to time"""
+        with self.lock:
+            self.max_age = max_age
+            self._prune()
+            self._commit()
+
+    def _written(self):
+        self.writes += 1
+        now = time.time()
+        if self.max_age is not None and now - self.pruned_at >= PRUNE_INTERVAL:
+            self._prune()
+        if self.writes >= COMMIT_BATCH or now - self.committed_at >= COMMIT_INTERVAL:
+            self._commit()
+
+    def _prune(self):
+        self.pruned_at = time.time()
+        self.db.execute("DELETE FROM listing WHERE fetched_at < ?", (self.pruned_at - self.max_age,))
+
+    def _commit(self):
+        self.db.commit()
+        self.writes = 0
+        self.committed_at = time.time()
+
+    def close(self):
+        with self.lock:
+            if self.db is not None:
+                self.db.commit()
+                self.db.close()
+                self.db = None
+
+
+class MetaCache(object):
+    def __init__(self, max_size=1000, max_items=200000, ttl=30*60, stale=6*60*60,
+                 store=None, decode=None):
+        self.max_size = max_size
+        self.max_items = max_items
+        self.ttl = ttl
+        self.stale = stale
+        self.entries = OrderedDict()    # key -> (fetched_at, value)
+        self.nitems = 0
+        self.lock = threading.Lock()
+        self.store = store
+        self.decode = decode    # raw listing items -> cached value
+        if store is not None:
+            store.expire(ttl + stale)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def peek(self, key):
+        """return (fetched_at, value) without loading or refreshing"""
+        return self.entries.get(key)
+
+    def get(self, key, loader, max_age=None):
+        """return cached value, calling loader() when missing or too old
+
+        Concurrent misses of a key share one loader() call. Nothing is
+        cached when loader() returns None. With max_age, a value older
+        than max_age seconds is reloaded now instead of served stale.
+        """
+        with self.lock:
+            ent = self.entries.pop(key, None)
+            if ent is not None:
+                self.entries[key] = ent
+        if ent is None and self.store is not None:
+            ent = self._restore(key)
+        if ent is not None:
+            age = time.time() - ent[0]
+            if age < (self.ttl if max_age is None else min(self.ttl, max_age)):
+                cache_events.inc('dir', 'hit')
+                return ent[1]
+            if max_age is None and age < self.ttl + self.stale:
+                cache_events.inc('dir', 'stale')
+                _engine.meta.submit(('meta', id(self), key), self._reload, key, loader)
+                return ent[1]
+        cache_events.inc('dir', 'miss' if max_age is None else 'warm')
+        return _engine.flights.call(('meta', id(self), key), self._reload, key, loader)
+
+    def _restore(self, key):
+        row = self.store.load(key)
+        if row is None:
+            return None
+        fetched_at, items = row
+        value = self.decode(items)
+        cache_events.inc('dir', 'restore')
+        self.put(key, value, fetched_at, persist=False)
+        return fetched_at, value
+
+    def _reload(self, key, loader):
+        value = loader()
+        if value is not None:
+            self.put(key, value)
+        return value
+
+    def put(self, key, value, fetched_at=None, persist=True):
+        fetched_at = fetched_at or time.time()
+        with self.lock:
+            self._pop(key)
+            self.entries[key] = (fetched_at, value)
+            self.nitems += len(value)
+            while self.entries and (len(self.entries) > self.max_size or self.nitems > self.max_items):
+                self._pop(next(iter(self.entries)))
+                cache_events.inc('dir', 'evict')
+        if persist and self.store is not None:
+            self.store.save(key, fetched_at, value.items)
+
+    def _pop(self, key):
+        ent = self.entries.pop(key, None)
+        if ent is not None:
+            self.nitems -= len(ent[1])
+        return ent
+
+    def invalidate(self, prefix):
+        """drop `prefix` and every path below it"""
+        prefix = prefix.rstrip('/')
+        with self.lock:
+            for key in [k for k in self.entries
+                        if k.rstrip('/') == prefix or k.startswith(prefix + '/')]:
+                self._pop(key)
+        if self.store is not None:
+            self.store.delete(prefix)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+"""
+Counters and latency histograms in Prometheus text format
+
+Upstream calls are timed with `timed(call)`, caches count their events in
+`cache_events`, and MetricsMiddleware times every WebDAV request, counts
+bytes served per share and answers GET /metrics.
+
+The page is only served to loopback clients unless `metrics_public` is set.
+A `metrics_path` inside a share (e.g. /bdyun/_metrics) requires the login of
+that share, as MetricsMiddleware runs inside HTTPAuthenticator.
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+LOOPBACK = ('127.0.0.1', '::1', '::ffff:127.0.0.1')
+
+
+class Metric(object):
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {}    # label values -> value
+        self.lock = threading.Lock()
+        _registry.append(self)
+
+    def _labelstr(self, values, extra=()):
+        pairs = zip(self.labels, values) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+                                 for k, v in pairs)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        with self.lock:
+            items = sorted(self.values.items())
+        for values, value in items:
+            lines.append('%s%s %s' % (self.name, self._labelstr(values), _num(value)))
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, *values, **kwargs):
+        amount = kwargs.get('amount', 1)
+        with self.lock:
+            self.values[values] = self.values.get(values, 0) + amount
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def dec(self, *values):
+        self.inc(*values, amount=-1)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *values):
+        with self.lock:
+            ent = self.values.get(values)
+            if ent is None:
+                ent = self.values[values] = [[0]*len(self.buckets), 0, 0.0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    ent[0][i] += 1
+            ent[1] += 1
+            ent[2] += value
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.kind)]
+        with self.lock:
+            items = sorted((k, (list(v[0]), v[1], v[2])) for k, v in self.values.items())
+        for values, (counts, count, total) in items:
+            for bound, n in zip(self.buckets, counts):
+                lines.append('%s_bucket%s %d' % (self.name, self._labelstr(values, [('le', _num(bound))]), n))
+            lines.append('%s_bucket%s %d' % (self.name, self._labelstr(values, [('le', '+Inf')]), count))
+            lines.append('%s_sum%s %s' % (self.name, self._labelstr(values), _num(total)))
+            lines.append('%s_count%s %d' % (self.name, self._labelstr(values), count))
+        return lines
+
+
+def _num(v):
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+_registry = []
+
+upstream_seconds = Histogram('klouddav_upstream_seconds',
+                             'latency of upstream calls (until response headers for downloads)', ('call',))
+upstream_errors = Counter('klouddav_upstream_errors_total', 'failed upstream calls', ('call',))
+cache_events = Counter('klouddav_cache_events_total', 'cache hits, misses and evictions', ('cache', 'event'))
+bytes_total = Counter('klouddav_bytes_total', 'bytes read from upstream and served to clients',
+                      ('share', 'direction'))
+coalesced = Counter('klouddav_coalesced_total', 'upstream calls that joined an identical one in flight', ('lane',))
+uploads = Counter('klouddav_uploads_total', 'stored PUT bodies by upload method', ('method',))
+active_streams = Gauge('klouddav_active_streams', 'open upstream file streams', ('share',))
+request_seconds = Histogram('klouddav_request_seconds', 'WebDAV request time including the response body', ('method',))
+
+
+class _Call(object):
+    failed = False
+
+@contextmanager
+def timed(call):
+    """time one upstream call; set `failed` on the yielded object to count an error"""
+    c = _Call()
+    began = time.time()
+    try:
+        yield c
+    except Exception:
+        c.failed = True
+        raise
+    finally:
+        upstream_seconds.observe(time.time() - began, call)
+        if c.failed:
+            upstream_errors.inc(call)
+
+
+def render():
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+class MetricsMiddleware(object):
+    """serve GET /metrics and time all other requests"""
+    def __init__(self, application, config):
+        self._application = application
+        self.path = config.get('metrics_path', '/metrics')
+        self.public = config.get('metrics_public', False)
+
+    @staticmethod
+    def isSuitable(config):
+        return True
+
+    def __call__(self, environ, start_response):
+        provider = environ.get('wsgidav.provider')
+        path = (provider.sharePath if provider is not None else '') + environ.get('PATH_INFO', '')
+        if path == self.path and environ['REQUEST_METHOD'] == 'GET':
+            if not self.public and provider is None and environ.get('REMOTE_ADDR') not in LOOPBACK:
+                start_response('403 Forbidden', [('Content-Type', 'text/plain'), ('Content-Length', '0')])
+                return ['']
+            body = render()
+            start_response('200 OK', [('Content-Type', 'text/plain; version=0.0.4'),
+                                      ('Content-Length', str(len(body)))])
+            return [body]
+        return self._serve(environ, start_response)
+
+    def _serve(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        provider = environ.get('wsgidav.provider')
+        share = provider.sharePath if provider is not None else ''
+        began = time.time()
+        sent = 0
+        app_iter = self._application(environ, start_response)
+        try:
+            for chunk in app_iter:
+                sent += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+            request_seconds.observe(time.time() - began, method)
+            if sent:
+                bytes_total.inc(share, 'served', amount=sent)
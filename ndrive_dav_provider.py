@@ -5,10 +5,15 @@ WebDAV wrapper for Naver Ndrive cloud service
 from ndrive import Ndrive
 from ndrive.urls import ndrive_urls
 import dateutil.parser
+from collections import OrderedDict
+import re
 import time
 import urllib
 import urllib2
-from util import UrlIO
+from util import open_url, DirEntries, mount_pool, _engine, SequenceTracker, prefetch_next
+from metacache import MetaCache, MetaStore
+from metrics import timed
+from warmer import Warmer
 from wsgidav.util import joinUri
 from wsgidav.dav_provider import DAVProvider, DAVNonCollection, DAVCollection
 from wsgidav.dav_error import DAVError, HTTP_FORBIDDEN, HTTP_INTERNAL_ERROR,\
@@ -19,47 +24,141 @@ __docformat__ = "reStructuredText"
 
 _logger = util.getModuleLogger(__name__)
 
-from util import _dircache
-_last_path = None
+SEARCH_DIR = '_search'      # /_search/<query>/: files whose name contains query
+CATEGORY_DIR = '_category'  # /_category/<name>/: files of a type
+CATEGORIES = OrderedDict([('doc', 1), ('image', 2), ('video', 3), ('music', 4), ('zip', 5)])
+SEARCH_PAGE = 100
+MAX_SEARCH_RESULTS = 2000
 
 class NdriveCollection(DAVCollection):
-    """Collection"""
-    def __init__(self, path, environ, ndrive):
+    """Collection
+
+    `rpath` is the folder on Ndrive when it differs from the DAV path
+    (members of search results).
+    """
+    def __init__(self, path, environ, ndrive, rpath=None):
         DAVCollection.__init__(self, path, environ)
         self.ndrive = ndrive
-        self.abspath = self.provider.sharePath + path
-        try:
-            self.nlist = _dircache[self.abspath]
-        except KeyError:
-            self.nlist = None
+        self.rpath = rpath or path
+        self.entries = None
         
     def getDisplayInfo(self):
         return {"type": "Collection"}
+
+    def _fetch(self):
+        nlist = _engine.meta.call(('list', id(self.provider), self.rpath), self._list)
+        if nlist is None or nlist is False:
+            _logger.error("fail to read %s" % self.rpath)
+            return None
+        return index_entries(nlist)
+
+    def _list(self):
+        with timed('get_list') as call:
+            nlist = self.ndrive.getList(self.rpath, type=3)
+            call.failed = nlist is None or nlist is False
+        return nlist
+
+    def _load(self):
+        if self.entries is None:
+            self.entries = self.provider.dircache.get(self.rpath, self._fetch)
+            if self.entries is None:
+                return index_entries([])
+        return self.entries
+
+    def refresh(self, max_age):
+        """reload the listing if it is older than max_age seconds"""
+        self.entries = self.provider.dircache.get(self.rpath, self._fetch, max_age)
     
     def getMemberNames(self):
-        if self.nlist is None:
-            self.nlist = self.ndrive.getList(self.path, type=3)
-            _dircache[self.abspath] = self.nlist
-        if self.nlist is None:
-            _logger.error("fail to read %s" % self.path)
-            return []
-        return [lastitem(item['href']) for item in self.nlist]
+        return self._load().member_names()
     
     def getMember(self, name):
-        if self.nlist is None:
-            self.nlist = self.ndrive.getList(self.path, type=3)
-            _dircache[self.abspath] = self.nlist
-        for item in self.nlist:
-            bname = lastitem(item['href'])
-            #path = joinUrl(self.path, name)
-            path = item['href'].encode('utf-8')
-            _logger.debug(path)
-            if bname == name:
-                if item['resourcetype'] == "collection":
-                    return NdriveCollection(path, self.environ, self.ndrive)
-                else:
-                    return NdriveFile(path, self.environ, self.ndrive, item)
-        return None
+        item = self._load().index.get(name)
+        if item is None and self.path == '/' and name in (SEARCH_DIR, CATEGORY_DIR):
+            return NdriveQueryRoot(joinUri(self.path, name), self.environ, self.ndrive, name)
+        if item is None:
+            return None
+        path = joinUri(self.path, name)
+        _logger.debug(path)
+        if item['resourcetype'] == "collection":
+            return NdriveCollection(path, self.environ, self.ndrive, item['href'].encode('utf-8'))
+        else:
+            return NdriveFile(path, self.environ, self.ndrive, item)
+
+
+class NdriveQueryRoot(DAVCollection):
+    """/_search or /_category, not listed in the root folder
+
+    A real root folder of the same name takes its place.
+    """
+    def __init__(self, path, environ, ndrive, kind):
+        DAVCollection.__init__(self, path, environ)
+        self.ndrive = ndrive
+        self.kind = kind
+
+    def getDisplayInfo(self):
+        return {"type": "Collection"}
+
+    def getMemberNames(self):
+        if self.kind == CATEGORY_DIR:
+            return CATEGORIES.keys()
+        return []
+
+    def getMember(self, name):
+        if self.kind == CATEGORY_DIR and name not in CATEGORIES:
+            return None
+        return NdriveResults(joinUri(self.path, name), self.environ, self.ndrive, self.kind, name)
+
+
+class NdriveResults(NdriveCollection):
+    """files found by one search or category query, cached like a folder"""
+    def __init__(self, path, environ, ndrive, kind, arg):
+        NdriveCollection.__init__(self, path, environ, ndrive)
+        self.kind = kind
+        self.arg = arg
+
+    def _list(self):
+        if self.kind == SEARCH_DIR:
+            return search(self.ndrive, self.arg)
+        return search(self.ndrive, '', CATEGORIES[self.arg])
+
+
+def search(ndrive, filename, filetype=None):
+    """files under / matching filename and filetype, None on failure
+
+    Calls DoSearch.ndrive directly: Ndrive.doSearch() of ndrive 0.1.0
+    drops non-empty results.
+    """
+    nlist = []
+    while len(nlist) < MAX_SEARCH_RESULTS:
+        data = {'filename': filename,
+                'filetype': filetype or 0,
+                'dstresource': '/',
+                'sharedowner': 'A',
+                'datatype': 'all',
+                'sort': 'update',
+                'order': 'desc',
+                'searchtype': 'filesearch',
+                'startnum': len(nlist),
+                'pagingrow': SEARCH_PAGE,
+                'includeworks': 'N',
+                'bodysearch': 'N',
+                'type': 3,
+                'userid': ndrive.user_id,
+                'useridx': ndrive.useridx,
+               }
+        with timed('search') as call:
+            s, page = ndrive.POST('doSearch', data)
+            call.failed = s is not True
+        if call.failed:
+            _logger.warning("search %r failed: %s" % (filename, page))
+            return None
+        if not isinstance(page, list):
+            break
+        nlist.extend(page)
+        if len(page) < SEARCH_PAGE:
+            break
+    return nlist
 
 
 class NdriveFile(DAVNonCollection):
@@ -81,16 +180,22 @@ class NdriveFile(DAVNonCollection):
     def getDisplayInfo(self):
         return {"type": "File"}
     def getEtag(self):
-        return None
+        return '%s-%s' % (self.info['resourceno'], re.sub(r'[^0-9]', '', self.info['getlastmodified']))
     def getLastModified(self):
         ts = dateutil.parser.parse(self.info['getlastmodified'])
         return time.mktime(ts.timetuple())
     def supportRanges(self):
-        return False
+        return True
 
     def getContent(self):
+        f = self._open()
+        prefetch_next(self.provider, self, is_file)
+        return f
+
+    def _open(self):
         """from downloadFile() in ndrive/client.py"""
-        url = ndrive_urls['download'] + self.path
+        rpath = self.info['href'].encode('utf-8')
+        url = ndrive_urls['download'] + rpath
         _logger.debug(url)
         data = {'attachment':2,
                 'userid': self.ndrive.user_id,
@@ -99,33 +204,47 @@ class NdriveFile(DAVNonCollection):
                }
         _logger.debug(self.ndrive.user_id)
         _logger.debug(self.ndrive.useridx)
-        return UrlIO(url, params=data, session=self.ndrive.session)
+        return open_url(url, self.getContentLength(), params=data, session=self.ndrive.session,
+                        cache_key=(self.provider.sharePath, rpath),
+                        stamp=(self.getContentLength(), self.info['getlastmodified']))
 
 
 def lastitem(path):
     return path.rstrip('/').split('/')[-1].encode('utf-8')
 
+def is_file(item):
+    return item['resourcetype'] != "collection"
+
+def index_entries(nlist):
+    return DirEntries(nlist, lambda item: lastitem(item['href']))
+
 #===============================================================================
 # DAVProvider
 #===============================================================================
 class NdriveProvider(DAVProvider):
-    def __init__(self, username, userpw):
+    def __init__(self, username, userpw,
+                 pool_connections=None, pool_maxsize=None, max_retries=None, dircache=None, metadb=None,
+                 warm=None):
         super(NdriveProvider, self).__init__()
         self.ndrive = Ndrive()
+        mount_pool(self.ndrive.session, pool_connections, pool_maxsize, max_retries)
+        store = MetaStore(metadb) if metadb else None
+        self.dircache = MetaCache(store=store, decode=index_entries, **(dircache or {}))
+        self.sequence = SequenceTracker()
         if self.ndrive.login(username, userpw):
             _logger.info("login ok")
         else:
             _logger.error("login fail")
+        self.warmer = Warmer(self, **warm) if warm else None
+        if self.warmer is not None:
+            self.warmer.start()
 
     def getResourceInst(self, path, environ):
         _logger.info("getResourceInst('%s')" % path)
         self._count_getResourceInst += 1
-        global _last_path
-        npath = self.sharePath + path
-        if _last_path == npath:
-            global _dircache
-            #del _dircache[npath]
-            _dircache.__delete__(npath)
-        _last_path = npath
         root = NdriveCollection("/", environ, self.ndrive)
         return root.resolve("", path)
+
+    def invalidate(self, path):
+        """forget cached listings of path and its subfolders"""
+        self.dircache.invalidate(path)
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Streamed PROPFIND Depth:infinity
+
+wsgidav answers a deep PROPFIND by listing folders one after another and
+building the whole multistatus document before sending a byte. For a
+collection, PropfindStreamer instead walks the tree with up to WALK_AHEAD
+folder listings in flight on the meta lane (which also fills the directory
+caches of every subfolder) and sends the <response> elements of each folder
+as soon as it is listed.
+
+It must be the innermost middleware, i.e. the first entry of
+middleware_stack, so that authentication still runs before it. The response
+has no Content-Length, so wsgidav closes the connection after it.
+"""
+from collections import deque
+from wsgidav import util, xml_tools
+from wsgidav.xml_tools import etree
+from wsgidav.dav_error import DAVError, HTTP_BAD_REQUEST
+from engine import BACKGROUND
+from util import _engine
+
+_logger = util.getModuleLogger(__name__)
+
+WALK_AHEAD = 8      # folder listings in flight per request
+
+
+def walk(res):
+    """yield [res] and then the members of every folder below it, one list per folder
+
+    Deep crawls run as BACKGROUND jobs, so interactive listings go first.
+    """
+    yield [res]
+    folders = deque([res])
+    pending = deque()
+    while folders or pending:
+        while folders and len(pending) < WALK_AHEAD:
+            coll = folders.popleft()
+            pending.append((coll, _engine.meta.submit(None, coll.getMemberList, priority=BACKGROUND)))
+        coll, task = pending.popleft()
+        try:
+            members = task.wait()
+        except Exception as e:
+            _logger.error("fail to list %s: %s" % (coll.path, e))
+            continue
+        folders.extend(m for m in members if m.isCollection)
+        yield members
+
+
+def parse_request(environ):
+    """(mode, property names) of a PROPFIND body, as in wsgidav's doPROPFIND"""
+    requestEL = util.parseXmlBody(environ, allowEmpty=True)
+    if requestEL is None:
+        return "allprop", []
+    if requestEL.tag != "{DAV:}propfind":
+        raise DAVError(HTTP_BAD_REQUEST)
+    mode = None
+    names = []
+    for pfnode in requestEL:
+        if pfnode.tag == "{DAV:}allprop":
+            if mode:
+                raise DAVError(HTTP_BAD_REQUEST)
+            mode = "allprop"
+        elif pfnode.tag == "{DAV:}propname":
+            if mode:
+                raise DAVError(HTTP_BAD_REQUEST)
+            mode = "propname"
+        elif pfnode.tag == "{DAV:}prop":
+            if mode not in (None, "named"):
+                raise DAVError(HTTP_BAD_REQUEST)
+            mode = "named"
+            names.extend(pfpnode.tag for pfpnode in pfnode)
+    return mode or "allprop", names
+
+
+def response_xml(res, mode, names):
+    """<response> element of one resource as utf-8 bytes"""
+    if mode == "named":
+        props = res.getProperties(mode, nameList=names)
+    else:
+        props = res.getProperties(mode)
+    ms = xml_tools.makeMultistatusEL()
+    util.addPropertyResponse(ms, res.getHref(), props)
+    if xml_tools.useLxml:
+        return etree.tostring(ms[0], encoding="utf-8", xml_declaration=False)
+    return etree.tostring(ms[0], encoding="utf-8")
+
+
+class PropfindStreamer(object):
+    """answer PROPFIND Depth:infinity on collections with a streamed multistatus"""
+    def __init__(self, application, config):
+        self._application = application
+
+    @staticmethod
+    def isSuitable(config):
+        return True
+
+    def __call__(self, environ, start_response):
+        provider = environ.get("wsgidav.provider")
+        if environ["REQUEST_METHOD"] != "PROPFIND" or provider is None \
+                or environ.get("HTTP_DEPTH", "infinity") != "infinity" or "HTTP_IF" in environ:
+            return self._application(environ, start_response)
+        res = provider.getResourceInst(environ["PATH_INFO"], environ)
+        if res is None or not res.isCollection:
+            return self._application(environ, start_response)
+        mode, names = parse_request(environ)
+        start_response("207 Multi-Status", [("Content-Type", "application/xml"),
+                                            ("Date", util.getRfc1123Time())])
+        return self._stream(res, mode, names)
+
+    def _stream(self, res, mode, names):
+        yield '<?xml version="1.0" encoding="utf-8"?>\n<D:multistatus xmlns:D="DAV:">'
+        count = 0
+        for members in walk(res):
+            yield "".join(response_xml(m, mode, names) for m in members)
+            count += len(members)
+        yield "</D:multistatus>"
+        _logger.info("PROPFIND %s: %d resources" % (res.path, count))
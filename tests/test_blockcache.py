@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import unittest
+from util import BlockCache
+
+A = ('share', '/a')
+B = ('share', '/b')
+
+
+class BlockCacheTest(unittest.TestCase):
+    def test_new_stamp_drops_old_blocks(self):
+        cache = BlockCache(100)
+        cache.put(A + (0,), 'x' * 10, (10, 1))
+        cache.validate(A, (10, 1))
+        self.assertIn(A + (0,), cache)
+        cache.validate(A, (10, 2))
+        self.assertNotIn(A + (0,), cache)
+        self.assertEqual(cache.nbytes, 0)
+        self.assertEqual(cache.files, {})
+
+    def test_stamp_leaves_with_last_block(self):
+        cache = BlockCache(25)
+        cache.put(A + (0,), 'x' * 10, (20, 1))
+        cache.put(A + (1,), 'x' * 10, (20, 1))
+        self.assertEqual(cache.files, {A: [(20, 1), 2]})
+        cache.put(B + (0,), 'y' * 10, (10, 1))
+        self.assertEqual(cache.files, {A: [(20, 1), 1], B: [(10, 1), 1]})
+        cache.put(B + (1,), 'y' * 10, (10, 1))
+        self.assertEqual(cache.files, {B: [(10, 1), 2]})
+        self.assertEqual(cache.nbytes, 20)
+
+    def test_put_again_counts_once(self):
+        cache = BlockCache(100)
+        cache.put(A + (0,), 'x' * 10, (10, 1))
+        cache.put(A + (0,), 'x' * 10, (10, 1))
+        self.assertEqual(cache.files, {A: [(10, 1), 1]})
+        self.assertEqual(cache.nbytes, 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from diskcache import DiskCache
+
+STAMP = (8, 1)
+
+
+class ReloadTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.caches = []
+        self.cache = self.reopen()
+        self.cache.put_block(('a',), STAMP, 0, 'AAAA')
+        self.cache.put_block(('b',), STAMP, 0, 'BBBB')
+        self.cache.save()
+        time.sleep(0.01)
+
+    def tearDown(self):
+        # nothing left for the atexit saves
+        for cache in self.caches:
+            cache.dirty = False
+        shutil.rmtree(self.dir)
+
+    def reopen(self):
+        cache = DiskCache(self.dir, 100, 4)
+        self.caches.append(cache)
+        return cache
+
+    def path(self, fkey):
+        return os.path.join(self.dir, self.cache._fname(fkey))
+
+    def test_saved_blocks_survive(self):
+        cache = self.reopen()
+        self.assertEqual(cache.get_block(('a',), STAMP, 0), 'AAAA')
+        self.assertEqual(cache.used, 8)
+
+    def test_file_rewritten_after_save_is_dropped(self):
+        # dropped for a new stamp and recreated sparse, index not saved again
+        self.cache.put_block(('b',), (8, 2), 1, 'bbbb')
+        cache = self.reopen()
+        self.assertIsNone(cache.get_block(('b',), STAMP, 0))
+        self.assertIsNone(cache.get_block(('b',), (8, 2), 1))
+        self.assertFalse(os.path.exists(self.path(('b',))))
+
+    def test_missing_file_is_dropped(self):
+        os.remove(self.path(('a',)))
+        cache = self.reopen()
+        self.assertIsNone(cache.get_block(('a',), STAMP, 0))
+        cache.put_block(('a',), STAMP, 0, 'AAAA')
+        self.assertEqual(cache.get_block(('a',), STAMP, 0), 'AAAA')
+
+    def test_unknown_file_is_deleted(self):
+        with open(self.path(('c',)), 'wb') as f:
+            f.write('c' * 8)
+        cache = self.reopen()
+        self.assertFalse(os.path.exists(self.path(('c',))))
+        self.assertEqual(cache.used, 8)
+
+
+if __name__ == '__main__':
+    unittest.main()
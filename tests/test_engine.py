@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import time
+import threading
+import unittest
+from engine import Lane, Flights, URGENT
+from metrics import coalesced
+
+
+class LaneTest(unittest.TestCase):
+    def setUp(self):
+        # one worker, held by a blocker job until release()
+        self.lane = Lane('test', 1)
+        self.gate = threading.Event()
+        self.running = threading.Event()
+        self.order = []
+        def block():
+            self.running.set()
+            self.gate.wait()
+        self.blocker = self.lane.submit(None, block, priority=URGENT)
+        self.running.wait()
+
+    def release(self):
+        self.gate.set()
+
+    def job(self, name, result=None):
+        def run():
+            self.order.append(name)
+            return result
+        return run
+
+    def test_same_key_is_one_task(self):
+        a = self.lane.submit('k', self.job('a', 1))
+        b = self.lane.submit('k', self.job('b', 2))
+        self.release()
+        self.assertIs(a, b)
+        self.assertEqual(b.wait(), 1)
+        self.assertEqual(self.order, ['a'])
+
+    def test_urgent_before_background(self):
+        bg = self.lane.submit(None, self.job('background'))
+        ur = self.lane.submit(None, self.job('urgent'), priority=URGENT)
+        self.release()
+        bg.wait()
+        ur.wait()
+        self.assertEqual(self.order, ['urgent', 'background'])
+
+    def test_bump(self):
+        first = self.lane.submit(None, self.job('first'))
+        second = self.lane.submit(None, self.job('second'))
+        self.lane.bump(second)
+        self.release()
+        first.wait()
+        second.wait()
+        self.assertEqual(self.order, ['second', 'first'])
+
+    def test_urgent_submit_of_queued_key_raises_priority(self):
+        other = self.lane.submit(None, self.job('other'))
+        task = self.lane.submit('k', self.job('k'))
+        self.assertIs(self.lane.submit('k', self.job('again'), priority=URGENT), task)
+        self.release()
+        other.wait()
+        task.wait()
+        self.assertEqual(self.order, ['k', 'other'])
+
+    def test_call_from_worker_takes_over_queued_job(self):
+        queued = self.lane.submit('k', self.job('queued', 'from queued'))
+        results = []
+        def caller():
+            results.append(self.lane.call('k', self.job('inline', 'from inline')))
+        outer = self.lane.submit(None, caller, priority=URGENT)
+        self.release()
+        outer.wait()
+        self.assertEqual(queued.wait(), 'from queued')
+        self.assertEqual(results, ['from queued'])
+        # the worker later dequeues the taken over job and skips it
+        self.lane.submit(None, self.job('last')).wait()
+        self.assertEqual(self.order, ['queued', 'last'])
+
+    def test_cancelled_job_is_skipped(self):
+        task = self.lane.submit('k', self.job('cancelled'))
+        task.cancelled = True
+        self.release()
+        self.assertIsNone(task.wait())
+        self.assertEqual(self.order, [])
+        # the key is free again for a new job
+        self.assertEqual(self.lane.submit('k', self.job('new', 3)).wait(), 3)
+
+    def test_error_is_raised_by_wait(self):
+        def fail():
+            raise ValueError('boom')
+        task = self.lane.submit(None, fail, priority=URGENT)
+        self.release()
+        self.assertRaises(ValueError, task.wait)
+
+    def test_inline_on_workers_only(self):
+        self.assertFalse(self.lane.inline())
+        task = self.lane.submit(None, self.lane.inline, priority=URGENT)
+        self.release()
+        self.assertTrue(task.wait())
+
+    def test_reserved_workers_raise_the_limit(self):
+        lane = Lane('sized', 2, max_workers=5)
+        self.assertEqual(lane.limit(), 2)
+        lane.reserve(4)
+        self.assertEqual(lane.limit(), 5)
+        lane.release(4)
+        self.assertEqual(lane.limit(), 2)
+
+    def tearDown(self):
+        self.release()
+        self.blocker.wait()
+
+
+class FlightsTest(unittest.TestCase):
+    def test_concurrent_callers_share_one_run(self):
+        flights = Flights()
+        gate = threading.Event()
+        entered = threading.Event()
+        calls = []
+        def load():
+            calls.append(1)
+            entered.set()
+            gate.wait()
+            return 'listing'
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flights.call('k', load)))
+        leader.start()
+        entered.wait()
+        joined = coalesced.values.get(('flights',), 0)
+        follower = threading.Thread(target=lambda: results.append(flights.call('k', load)))
+        follower.start()
+        while coalesced.values.get(('flights',), 0) == joined:
+            time.sleep(0.001)
+        gate.set()
+        leader.join()
+        follower.join()
+        self.assertEqual(results, ['listing', 'listing'])
+        self.assertEqual(calls, [1])
+        self.assertEqual(flights.pending, {})
+
+    def test_lane_worker_does_not_wait_for_caller_outside(self):
+        # the caller fans out on the lane while both of its workers want
+        # the same key: they must not block on the caller
+        lane = Lane('fanout', 2)
+        flights = Flights(lane)
+        entered = threading.Event()
+        go = threading.Event()
+        def load():
+            if threading.current_thread() not in lane.threads:
+                entered.set()
+                go.wait()
+            return sum(lane.map(lambda x: x, [1, 2]))
+        results = []
+        leader = threading.Thread(target=lambda: results.append(flights.call('k', load)))
+        leader.start()
+        entered.wait()
+        followers = [lane.submit(None, flights.call, 'k', load) for i in range(2)]
+        for task in followers:
+            self.assertTrue(task.done.wait(5))
+            self.assertEqual(task.wait(), 3)
+        go.set()
+        leader.join()
+        self.assertEqual(results, [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
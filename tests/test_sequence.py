@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import threading
+import unittest
+from util import natural_key, next_in_order, SequenceTracker, prefetch_head, BLOCK_SIZE
+
+
+class NaturalKeyTest(unittest.TestCase):
+    def test_numbers_sort_by_value(self):
+        names = ['ep10.mkv', 'ep2.mkv', 'ep1.mkv', 'EP3.mkv']
+        self.assertEqual(sorted(names, key=natural_key),
+                         ['ep1.mkv', 'ep2.mkv', 'EP3.mkv', 'ep10.mkv'])
+
+    def test_text_only(self):
+        self.assertEqual(sorted(['b', 'A', 'c'], key=natural_key), ['A', 'b', 'c'])
+
+
+class NextInOrderTest(unittest.TestCase):
+    names = ['ep10', 'ep1', 'ep3', 'ep2', 'ep11']
+
+    def test_after_sequential_open(self):
+        self.assertEqual(next_in_order(self.names, 'ep1', 'ep2'), ['ep3', 'ep10'])
+        self.assertEqual(next_in_order(self.names, 'ep2', 'ep3', count=1), ['ep10'])
+
+    def test_end_of_folder(self):
+        self.assertEqual(next_in_order(self.names, 'ep10', 'ep11'), [])
+
+    def test_not_sequential(self):
+        self.assertEqual(next_in_order(self.names, 'ep1', 'ep3'), [])
+        self.assertEqual(next_in_order(self.names, None, 'ep1'), [])
+        self.assertEqual(next_in_order(self.names, 'ep1', 'missing'), [])
+
+
+class SequenceTrackerTest(unittest.TestCase):
+    def test_returns_previous_open(self):
+        seq = SequenceTracker()
+        self.assertIsNone(seq.opened('a', '/tv', 'ep1'))
+        self.assertEqual(seq.opened('a', '/tv', 'ep2'), 'ep1')
+        # the same file again (e.g. a seek) is not a step
+        self.assertIsNone(seq.opened('a', '/tv', 'ep2'))
+
+    def test_clients_and_folders_are_separate(self):
+        seq = SequenceTracker()
+        seq.opened('a', '/tv', 'ep1')
+        self.assertIsNone(seq.opened('b', '/tv', 'ep2'))
+        self.assertIsNone(seq.opened('a', '/movies', 'ep2'))
+        self.assertEqual(seq.opened('a', '/tv', 'ep2'), 'ep1')
+
+    def test_oldest_is_dropped(self):
+        seq = SequenceTracker(max_size=2)
+        seq.opened('a', '/1', 'x')
+        seq.opened('a', '/2', 'x')
+        seq.opened('a', '/3', 'x')
+        self.assertIsNone(seq.opened('a', '/1', 'y'))
+        self.assertEqual(seq.opened('a', '/3', 'y'), 'x')
+
+
+class FakeIO(object):
+    def __init__(self, size):
+        self.cache_key = ('share', '/next')
+        self.local = None
+        self.size = size
+        self.events = []
+        self.closed = threading.Event()
+
+    def _get_block(self, idx):
+        self.events.append(idx)
+
+    def close(self):
+        self.events.append('close')
+        self.closed.set()
+
+
+class PrefetchHeadTest(unittest.TestCase):
+    def test_closes_after_loading(self):
+        fileobj = FakeIO(3*BLOCK_SIZE - 1)
+        prefetch_head(fileobj, 4)
+        self.assertTrue(fileobj.closed.wait(5))
+        self.assertEqual(fileobj.events, [0, 1, 2, 'close'])
+
+    def test_uncached_file_is_only_closed(self):
+        fileobj = FakeIO(BLOCK_SIZE)
+        fileobj.cache_key = None
+        prefetch_head(fileobj)
+        self.assertEqual(fileobj.events, ['close'])
+
+
+if __name__ == '__main__':
+    unittest.main()
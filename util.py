@@ -1,6 +1,55 @@
 # -*- coding: utf-8 -*-
 from io import RawIOBase
+from collections import OrderedDict
+import os.path
+import re
+import time
+import threading
 import requests
+from requests.adapters import HTTPAdapter
+from wsgidav.util import getModuleLogger, getUriParent
+from engine import Engine
+from metrics import timed, cache_events, bytes_total, active_streams
+
+_logger = getModuleLogger(__name__)
+
+# block cache settings (may be overridden from wsgidav.conf)
+BLOCK_SIZE = 1024*1024
+READAHEAD_BLOCKS = 4
+BLOCK_CACHE_SIZE = 64*1024*1024
+SKIP_CHUNK = 64*1024
+MAX_READALL = 32*1024*1024  # read(-1) refuses more; iterate or use iter_chunks()
+
+# sequential access: when a client opens the files of a folder in name order,
+# the first NEXT_FILE_BLOCKS blocks of the next NEXT_FILES files are prefetched
+NEXT_FILES = 2
+NEXT_FILE_BLOCKS = 4    # one segment
+
+# segmented download settings (may be overridden from wsgidav.conf)
+MIN_SIZE_FOR_SEGMENTED = 200*1024*1024
+SEGMENT_SIZE = 4*1024*1024      # multiple of BLOCK_SIZE
+SEGMENT_CONNECTIONS = 4
+
+# upstream i/o engine (see engine.py)
+META_WORKERS = 8        # listing and metadata calls
+DATA_WORKERS = 16       # block and segment downloads without open streams
+DATA_MAX_WORKERS = 256  # ceiling while streams reserve their connections
+HTTP_TIMEOUT = (10, 50) # connect, read seconds
+
+# http connection pool defaults
+POOL_CONNECTIONS = 4    # hosts kept in pool
+POOL_MAXSIZE = 16       # connections per host
+MAX_RETRIES = 2
+
+def mount_pool(session, pool_connections=None, pool_maxsize=None, max_retries=None):
+    """attach a keep-alive connection pool to a requests session"""
+    adapter = HTTPAdapter(
+        pool_connections=POOL_CONNECTIONS if pool_connections is None else pool_connections,
+        pool_maxsize=POOL_MAXSIZE if pool_maxsize is None else pool_maxsize,
+        max_retries=MAX_RETRIES if max_retries is None else max_retries)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
 
 # file io wrapper for requests module
 class RequestsIO(RawIOBase):
@@ -13,10 +62,16 @@ class RequestsIO(RawIOBase):
         return True
 
     def read(self, n=-1):
-        if n == -1:
-            return self.req.content
+        if n is None or n < 0:
+            return self.readall()
         return self.req.raw.read(n)
 
+    def readinto(self, b):
+        return _raw_readinto(self.req.raw, memoryview(b))
+
+    def readall(self):
+        return _readall(self)
+
     def seekable(self):
         return False
 
@@ -24,7 +79,28 @@ class RequestsIO(RawIOBase):
         return False
 
 class UrlIO(RawIOBase):
-    def __init__(self, url, size=-1, params={}, headers={}, cookies={}, session=None):
+    """file io over http
+
+    With `cache_key` = (provider, path) and a known size, reads are done in
+    BLOCK_SIZE aligned blocks which are kept in `_blockcache` (and
+    `_diskcache` if enabled), and the next `readahead` blocks are fetched in
+    background. A file completely held in `_diskcache` is read locally.
+
+    Block fetches run on the `data` lane of `_engine`; a block being
+    prefetched is waited for instead of fetched again.
+
+    `refresh` is called once for a new url when the server answers 403/410
+    (an expired download link).
+
+    When the server ignores Range (200 instead of 206), reads fall back to a
+    single live download which skips forward to the wanted offset.
+
+    read() returns slices of the cached blocks, readinto() fills a caller's
+    buffer without intermediate strings and iterating yields BLOCK_SIZE
+    chunks; read(-1) refuses more than MAX_READALL bytes.
+    """
+    def __init__(self, url, size=-1, params={}, headers={}, cookies={}, session=None,
+                 cache_key=None, stamp=None, readahead=None, refresh=None):
         super(UrlIO, self).__init__()
         self.url = url
         self.size = size
@@ -36,29 +112,198 @@ class UrlIO(RawIOBase):
         self.cookies = cookies
         self.session = session if session else requests
         self.req = None
+        self.stream_pos = 0
+        self.ranges = True
+        self.lock = threading.Lock()
+        self.refresh = refresh
+        self.cache_key = cache_key if size > 0 else None
+        self.stamp = stamp
+        self.readahead = READAHEAD_BLOCKS if readahead is None else readahead
+        self.share = cache_key[0] if cache_key else ''
+        active_streams.inc(self.share)
+        self.lane_slots = 1     # data lane workers reserved for this stream
+        _engine.data.reserve(self.lane_slots)
+        self.local = None
+        if self.cache_key is not None:
+            _blockcache.validate(self.cache_key, stamp)
+            if _diskcache is not None:
+                self.local = _diskcache.open(self.cache_key, stamp)
 
     def readable(self):
         return True
 
     def read(self, n=-1):
+        if n is None or n < 0:
+            return self.readall()
+        if self.local is not None:
+            _b = self.local.read(n)
+            self.offset += len(_b)
+            return _b
+        if self.cache_key is not None:
+            return _join([block if skip == 0 and m == len(block) else block[skip:skip+m]
+                          for block, skip, m in self._blocks(n)])
+        self._open_stream(n)
+        _b = self.req.raw.read(n)
+        self._advance(len(_b))
+        return _b
+
+    def readinto(self, b):
+        view = memoryview(b)
+        if self.local is not None:
+            m = self.local.readinto(view)
+            self.offset += m
+            return m
+        if self.cache_key is not None:
+            return self._readinto_blocks(view)
+        self._open_stream(len(view))
+        m = _raw_readinto(self.req.raw, view)
+        self._advance(m)
+        return m
+
+    def readall(self):
+        if self.size - self.offset > MAX_READALL:
+            raise IOError("%d bytes left in %s, iterate over it instead" % (self.size - self.offset, self.url))
+        return _readall(self)
+
+    def __iter__(self):
+        """the rest of the file in chunks of up to BLOCK_SIZE bytes (not lines)"""
+        return iter(lambda: self.read(BLOCK_SIZE), b'')
+
+    def _open_stream(self, n):
         if self.req is None:
             hdrs = self.headers.copy()
             if self.range_mode:
-                self.last_pos = (self.size-1) if n == -1 else (self.offset+n-1)
-                if self.last_pos >= self.size:
-                    self.last_pos = (self.size-1)
+                self.last_pos = min(self.offset+n, self.size) - 1
                 hdrs.update({"Range":"bytes=%d-%d" % (self.offset, self.last_pos)})
-            self.req = self.session.get(self.url, params=self.params, headers=hdrs, cookies=self.cookies, stream=True, timeout=50)
-        if n == -1:
-            _b = self.req.content
-        else:
-            _b = self.req.raw.read(n)
-        m = len(_b)
+            self.req = self._get(hdrs, stream=True)
+            if self.range_mode and self.req.status_code == 200:
+                self.ranges = False     # Range ignored
+                self.last_pos = self.size - 1
+                self._skip(self.req, self.offset)
+
+    def _advance(self, m):
+        self._count(m)
         self.offset += m
         if self.offset > self.last_pos:
             self.req = None     # fetch next block
+
+    def _readinto_blocks(self, view):
+        pos = 0
+        for block, skip, m in self._blocks(len(view)):
+            view[pos:pos+m] = memoryview(block)[skip:skip+m]
+            pos += m
+        return pos
+
+    def _blocks(self, n):
+        """yield (block, skip, length) covering the next n bytes, advancing the offset"""
+        end = min(self.offset + n, self.size)
+        idx = None
+        while self.offset < end:
+            idx, skip = divmod(self.offset, BLOCK_SIZE)
+            block = self._get_block(idx)
+            m = min(end - self.offset, len(block) - skip)
+            if m <= 0:
+                break
+            self.offset += m
+            yield block, skip, m
+        if idx is not None:
+            self._prefetch(idx+1)
+
+    def _cached_block(self, idx):
+        key = self.cache_key + (idx,)
+        data = _blockcache.get(key)
+        if data is None and _diskcache is not None:
+            data = _diskcache.get_block(self.cache_key, self.stamp, idx)
+            if data is not None:
+                _blockcache.put(key, data, self.stamp)
+        return data
+
+    def _get_block(self, idx):
+        data = self._cached_block(idx)
+        if data is None:
+            data = _engine.data.call(self.cache_key + (idx,), self._load_block, idx)
+        return data
+
+    def _load_block(self, idx):
+        data = self._fetch_block(idx)
+        _blockcache.put(self.cache_key + (idx,), data, self.stamp)
+        if _diskcache is not None:
+            _diskcache.put_block(self.cache_key, self.stamp, idx, data)
+        return data
+
+    def _fetch_block(self, idx):
+        first = idx*BLOCK_SIZE
+        last = min(first+BLOCK_SIZE, self.size) - 1
+        if self.ranges:
+            hdrs = self.headers.copy()
+            hdrs.update({"Range":"bytes=%d-%d" % (first, last)})
+            req = self._get(hdrs, stream=True)
+            req.raise_for_status()
+            if req.status_code == 206:
+                data = req.content
+                self._count(len(data))
+                return data
+            req.close()
+            if self.ranges:
+                _logger.info("Range ignored by %s, reading through" % self.url)
+                self.ranges = False
+        with self.lock:
+            return self._read_stream(first, last-first+1)
+
+    def _read_stream(self, pos, n):
+        """read n bytes at pos from one live download of the whole file"""
+        if self.req is None or self.stream_pos > pos:
+            self._close_stream()
+            self.req = self._get(self.headers.copy(), stream=True)
+            self.req.raise_for_status()
+            self.stream_pos = 0
+        self.stream_pos += self._skip(self.req, pos - self.stream_pos)
+        _b = self.req.raw.read(n)
+        self._count(len(_b))
+        self.stream_pos += len(_b)
         return _b
 
+    def _close_stream(self):
+        if self.req is not None:
+            self.req.close()
+            self.req = None
+
+    def _skip(self, req, n):
+        skipped = 0
+        while skipped < n:
+            _b = req.raw.read(min(SKIP_CHUNK, n - skipped))
+            if not _b:
+                raise IOError("unexpected end of stream %s" % self.url)
+            skipped += len(_b)
+        self._count(skipped)
+        return skipped
+
+    def _count(self, n):
+        bytes_total.inc(self.share, 'upstream', amount=n)
+
+    def _get(self, hdrs, stream=False):
+        req = self._request(hdrs, stream)
+        if req.status_code in (403, 410) and self.refresh is not None:
+            req.close()
+            self.url = self.refresh()
+            req = self._request(hdrs, stream)
+        return req
+
+    def _request(self, hdrs, stream):
+        with timed('range' if 'Range' in hdrs else 'download') as call:
+            req = self.session.get(self.url, params=self.params, headers=hdrs, cookies=self.cookies, stream=stream, timeout=HTTP_TIMEOUT)
+            call.failed = req.status_code >= 400
+        return req
+
+    def _prefetch(self, start):
+        if not self.ranges:
+            return
+        nblocks = (self.size + BLOCK_SIZE - 1) // BLOCK_SIZE
+        for idx in range(start, min(start+self.readahead, nblocks)):
+            key = self.cache_key + (idx,)
+            if key not in _blockcache:
+                _engine.data.submit(key, self._load_block, idx)
+
     def seekable(self):
         return True
 
@@ -71,6 +316,8 @@ class UrlIO(RawIOBase):
             self.offset = self.size - offset
         self.range_mode = True
         self.req = None
+        if self.local is not None:
+            self.local.seek(self.offset)
         return self.offset
 
     def tell(self):
@@ -79,7 +326,421 @@ class UrlIO(RawIOBase):
     def writable(self):
         return False
 
+    def close(self):
+        if self.local is not None:
+            self.local.close()
+        self._close_stream()
+        if not self.closed:
+            active_streams.dec(self.share)
+            _engine.data.release(self.lane_slots)
+        super(UrlIO, self).close()
+
+class SegmentedIO(UrlIO):
+    """UrlIO downloading sequential reads over several connections
+
+    The file is split into `segment_size` segments which are fetched on the
+    `data` lane of `_engine`, at most `connections` at a time per stream
+    with Range requests; the stream reserves as many lane workers while it is
+    open. Finished segments wait in a reorder buffer of at most `connections`
+    segments until the reader consumes them in order. The window starts at one segment after a seek and
+    grows while reads stay sequential. Segment blocks are also stored in
+    `_diskcache`, but not in the memory block cache. Streams of one
+    `cache_key` share the fetch of a segment they read at the same time.
+    """
+    def __init__(self, url, size, connections=None, segment_size=None, **kwargs):
+        super(SegmentedIO, self).__init__(url, size=size, **kwargs)
+        self.connections = connections or SEGMENT_CONNECTIONS
+        _engine.data.reserve(self.connections - self.lane_slots)
+        self.lane_slots = self.connections
+        self.segment_size = segment_size or SEGMENT_SIZE
+        self.nsegments = (size + self.segment_size - 1) // self.segment_size
+        self.slots = {}     # segment index -> engine Task
+        self.run = 0
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            return self.readall()
+        if self.local is not None or not self.ranges:
+            return super(SegmentedIO, self).read(n)
+        pieces = []
+        for data, skip, m in self._segments(n):
+            if data is None:
+                pieces.append(super(SegmentedIO, self).read(n - sum(len(p) for p in pieces)))
+                break
+            pieces.append(data if skip == 0 and m == len(data) else data[skip:skip+m])
+        return _join(pieces)
+
+    def readinto(self, b):
+        view = memoryview(b)
+        if self.local is not None or not self.ranges:
+            return super(SegmentedIO, self).readinto(view)
+        n = min(len(view), self.size - self.offset)
+        pos = 0
+        for data, skip, m in self._segments(n):
+            if data is None:
+                return pos + super(SegmentedIO, self).readinto(view[pos:n])
+            view[pos:pos+m] = memoryview(data)[skip:skip+m]
+            pos += m
+        return pos
+
+    def _segments(self, n):
+        """yield (segment, skip, length) covering the next n bytes, advancing the offset
+
+        (None, 0, 0) ends it when the server turns out to ignore Range.
+        """
+        end = min(self.offset + n, self.size)
+        while self.offset < end:
+            seg, skip = divmod(self.offset, self.segment_size)
+            data = self._segment(seg)
+            if data is None:
+                self.range_mode = True
+                yield None, 0, 0
+                return
+            m = min(end - self.offset, len(data) - skip)
+            if m <= 0:
+                return
+            self.offset += m
+            yield data, skip, m
+
+    def _segment(self, seg):
+        if seg-1 in self.slots:
+            self.run += 1
+        elif seg not in self.slots:
+            self.run = 0
+        window = min(self.connections, self.run+1)
+        for s in self.slots.keys():
+            if s < seg or s >= seg+window:
+                self.slots.pop(s).cancelled = True
+        for s in range(seg, min(seg+window, self.nsegments)):
+            if s not in self.slots:
+                self.slots[s] = _engine.data.submit(self._segment_key(s), self._load_segment, s)
+        while True:
+            slot = self.slots[seg]
+            _engine.data.bump(slot)
+            slot.done.wait()
+            if not (slot.cancelled and slot.result is None and slot.error is None):
+                break
+            # cancelled by another stream sharing it
+            self.slots[seg] = _engine.data.submit(self._segment_key(seg), self._load_segment, seg)
+        if slot.error is not None:
+            if not self.ranges:
+                return None
+            raise IOError("segment %d of %s: %s" % (seg, self.url, slot.error))
+        return slot.result
+
+    def _segment_key(self, seg):
+        if self.cache_key is None:
+            return None
+        return self.cache_key + ('segment', self.segment_size, seg)
+
+    def _load_segment(self, seg):
+        first = seg*self.segment_size
+        last = min(first+self.segment_size, self.size) - 1
+        blocks = range(first // BLOCK_SIZE, last // BLOCK_SIZE + 1)
+        if self.cache_key is not None:
+            cached = [self._cached_block(idx) for idx in blocks]
+            if None not in cached:
+                return b''.join(cached)[first-blocks[0]*BLOCK_SIZE:last+1-blocks[0]*BLOCK_SIZE]
+        hdrs = self.headers.copy()
+        hdrs.update({"Range":"bytes=%d-%d" % (first, last)})
+        req = self._get(hdrs, stream=True)
+        req.raise_for_status()
+        if req.status_code != 206:
+            req.close()
+            self.ranges = False
+            raise IOError("Range ignored")
+        data = req.content
+        self._count(len(data))
+        if self.cache_key is not None and _diskcache is not None and first % BLOCK_SIZE == 0:
+            for idx in blocks:
+                pos = idx*BLOCK_SIZE - first
+                _diskcache.put_block(self.cache_key, self.stamp, idx, data[pos:pos+BLOCK_SIZE])
+        return data
+
+    def close(self):
+        for slot in self.slots.values():
+            slot.cancelled = True
+        self.slots = {}
+        super(SegmentedIO, self).close()
+
+
+def _raw_readinto(raw, view):
+    """fill view from a urllib3 response, short only at end of stream"""
+    pos = 0
+    while pos < len(view):
+        m = raw.readinto(view[pos:])
+        if not m:
+            break
+        pos += m
+    return pos
+
+
+def _join(pieces):
+    return pieces[0] if len(pieces) == 1 else b''.join(pieces)
+
+
+def _readall(fileobj):
+    """the rest of fileobj, refusing more than MAX_READALL bytes"""
+    pieces = []
+    total = 0
+    for chunk in iter_chunks(fileobj):
+        total += len(chunk)
+        if total > MAX_READALL:
+            raise IOError("more than %d bytes, iterate over the file instead" % MAX_READALL)
+        pieces.append(chunk.tobytes())
+    return b''.join(pieces)
+
+
+def iter_chunks(fileobj, chunk_size=None, end=None):
+    """yield memoryviews of the data of fileobj up to offset `end`
+
+    All chunks share one buffer of chunk_size (default BLOCK_SIZE) bytes, so
+    a chunk is only valid until the next one is requested. Use this instead
+    of read(-1) to stream large files in constant memory.
+    """
+    buf = bytearray(chunk_size or BLOCK_SIZE)
+    view = memoryview(buf)
+    while True:
+        want = len(buf)
+        if end is not None:
+            want = min(want, end - fileobj.tell())
+        if want <= 0:
+            return
+        m = fileobj.readinto(view[:want])
+        if not m:
+            return
+        yield view[:m]
+
+
+def open_url(url, size, **kwargs):
+    """UrlIO for a remote file, segmented for files of MIN_SIZE_FOR_SEGMENTED"""
+    if size >= MIN_SIZE_FOR_SEGMENTED:
+        return SegmentedIO(url, size, **kwargs)
+    return UrlIO(url, size=size, **kwargs)
+
+
+def prefetch_head(fileobj, nblocks=None):
+    """load the first blocks of a UrlIO into the block cache in background
+
+    The background job owns fileobj and closes it when done.
+    """
+    if fileobj.cache_key is None or fileobj.local is not None:
+        fileobj.close()
+        return
+    nblocks = NEXT_FILE_BLOCKS if nblocks is None else nblocks
+    _engine.data.submit(None, _load_head, fileobj, nblocks)
+
+
+def _load_head(fileobj, nblocks):
+    try:
+        for idx in range(min(nblocks, (fileobj.size + BLOCK_SIZE - 1) // BLOCK_SIZE)):
+            fileobj._get_block(idx)
+    finally:
+        fileobj.close()
+
+#------------------------------------------------
+def client_id(environ):
+    return environ.get('REMOTE_ADDR'), environ.get('HTTP_USER_AGENT')
+
+
+def natural_key(name):
+    """sort key putting ep2 before ep10"""
+    return [int(t) if t.isdigit() else t.lower() for t in re.split(r'(\d+)', name)]
+
+
+def next_in_order(names, prev, name, count=None):
+    """the names after `name` in natural order if `prev` is the one right before it"""
+    order = sorted(names, key=natural_key)
+    try:
+        i = order.index(name)
+    except ValueError:
+        return []
+    if i == 0 or order[i-1] != prev:
+        return []
+    return order[i+1:i+1+(NEXT_FILES if count is None else count)]
+
+
+def prefetch_next(provider, res, is_file):
+    """when res is opened right after the file before it, prefetch the next files
+
+    The next files are taken from the cached listing of the folder only,
+    is_file(item) tells its files from its subfolders.
+    """
+    folder = getUriParent(res.path)
+    prev = provider.sequence.opened(client_id(res.environ), folder, res.name)
+    if prev is not None:
+        _engine.meta.submit(None, _prefetch_next, provider, folder, prev, res.name, is_file)
+
+
+def _prefetch_next(provider, folder, prev, name, is_file):
+    coll = provider.getResourceInst(folder, {"wsgidav.provider": provider})
+    if coll is None or not hasattr(coll, 'rpath'):
+        return
+    ent = provider.dircache.peek(coll.rpath)
+    if ent is None:
+        return
+    coll.entries = ent[1]
+    files = [n for n, item in zip(coll.entries.names, coll.entries.items) if is_file(item)]
+    for n in next_in_order(files, prev, name):
+        prefetch_head(coll.getMember(n)._open())
+
+
+class SequenceTracker(object):
+    """last file opened by each client in each folder"""
+    def __init__(self, max_size=1000):
+        self.max_size = max_size
+        self.last = OrderedDict()   # (client, folder) -> name
+        self.lock = threading.Lock()
+
+    def opened(self, client, folder, name):
+        """record an open, return the file opened there before (None if it is the same)"""
+        key = (client, folder)
+        with self.lock:
+            prev = self.last.pop(key, None)
+            self.last[key] = name
+            while len(self.last) > self.max_size:
+                self.last.popitem(last=False)
+        return None if prev == name else prev
+
+#------------------------------------------------
+class BlockCache(object):
+    """in-memory LRU cache of file blocks bounded by total bytes
+
+    Keys are (provider, path, block index). The stamp (size, mtime) of a
+    file is kept while any of its blocks is cached.
+    """
+    def __init__(self, max_bytes=BLOCK_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self.blocks = OrderedDict()
+        self.files = {}     # file key -> [stamp, number of cached blocks]
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self.blocks
+
+    def get(self, key):
+        with self.lock:
+            data = self.blocks.pop(key, None)
+            if data is not None:
+                self.blocks[key] = data
+        cache_events.inc('block', 'miss' if data is None else 'hit')
+        return data
+
+    def put(self, key, data, stamp=None):
+        """cache a block of the file version `stamp`"""
+        fkey = key[:-1]
+        with self.lock:
+            ent = self.files.get(fkey)
+            if ent is not None and ent[0] != stamp:
+                self._drop_file(fkey)
+                ent = None
+            if ent is None:
+                ent = self.files[fkey] = [stamp, 0]
+            old = self.blocks.pop(key, None)
+            if old is not None:
+                self.nbytes -= len(old)
+            else:
+                ent[1] += 1
+            self.blocks[key] = data
+            self.nbytes += len(data)
+            while self.nbytes > self.max_bytes and self.blocks:
+                old_key, old = self.blocks.popitem(last=False)
+                self._forget(old_key, old)
+                cache_events.inc('block', 'evict')
+
+    def validate(self, fkey, stamp):
+        """drop blocks of a file whose stamp (size, mtime) has changed"""
+        with self.lock:
+            ent = self.files.get(fkey)
+            if ent is not None and ent[0] != stamp:
+                self._drop_file(fkey)
+
+    def _forget(self, key, data):
+        self.nbytes -= len(data)
+        ent = self.files[key[:-1]]
+        ent[1] -= 1
+        if ent[1] == 0:
+            del self.files[key[:-1]]
+
+    def _drop_file(self, fkey):
+        for key in [k for k in self.blocks if k[:-1] == fkey]:
+            self._forget(key, self.blocks.pop(key))
+
+_blockcache = BlockCache()
+_engine = Engine(META_WORKERS, DATA_WORKERS, DATA_MAX_WORKERS)
+_diskcache = None
+
+def setup_diskcache(cachedir, max_size):
+    """enable the persistent content cache under `cachedir`"""
+    global _diskcache
+    from diskcache import DiskCache
+    _diskcache = DiskCache(cachedir, max_size, BLOCK_SIZE)
+
 #------------------------------------------------
-from lru import LRUCacheDict
+class LinkCache(object):
+    """resolved download urls (or other values) with their expiry time"""
+    def __init__(self, name='link'):
+        self.name = name
+        self.links = {}
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        ent = self.links.get(key)
+        return ent is not None and ent[1] > time.time()
+
+    def get(self, key):
+        with self.lock:
+            ent = self.links.get(key)
+            if ent is not None and ent[1] <= time.time():
+                del self.links[key]
+                ent = None
+        cache_events.inc(self.name, 'miss' if ent is None else 'hit')
+        return None if ent is None else ent[0]
+
+    def put(self, key, url, expires):
+        with self.lock:
+            self.links[key] = (url, expires)
+
+    def pop(self, key):
+        with self.lock:
+            self.links.pop(key, None)
+
+
+class DirEntries(object):
+    """directory listing indexed by member name
+
+    `names` holds the utf-8 encoded member names in listing order and
+    `index` maps them to listing entries. Synthesized members (e.g. .m3u8
+    playlists) are kept in `virtual` as name -> entry of the source file.
+    Repeated names (search results from several folders) get a " (n)"
+    suffix.
+    """
+    def __init__(self, items, namefunc):
+        self.items = items
+        self.names = []
+        self.index = {}
+        for item in items:
+            name = namefunc(item)
+            if name in self.index:
+                rname, ext = os.path.splitext(name)
+                n = 2
+                while '%s (%d)%s' % (rname, n, ext) in self.index:
+                    n += 1
+                name = '%s (%d)%s' % (rname, n, ext)
+            self.names.append(name)
+            self.index[name] = item
+        self.virtual = OrderedDict()
+        self.members = None
+
+    def __len__(self):
+        return len(self.items)
+
+    def add_virtual(self, name, item):
+        self.virtual[name] = item
+        self.members = None
 
-_dircache = LRUCacheDict(max_size=30, expiration=30*60)
+    def member_names(self):
+        if self.members is None:
+            self.members = self.names + self.virtual.keys()
+        return self.members
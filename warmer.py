@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+"""
+Background cache warmer
+
+A Warmer re-lists the hot folders of a share every `interval` seconds, each
+down to its configured depth, so that their directory cache entries are
+renewed before they expire (at WARM_AT of the cache ttl) instead of by the
+next user who opens them. Folders are visited as BACKGROUND jobs on the
+meta lane, at most `workers` at a time, and at most `rate` upstream
+listings are started per second.
+
+After a folder is listed, the provider's warm_members(coll, members, take)
+hook, if it has one, may resolve more of it; `take()` waits for the rate
+budget before each upstream call.
+"""
+import time
+import threading
+from collections import deque
+from wsgidav import util
+from util import _engine
+
+_logger = util.getModuleLogger(__name__)
+
+WARM_AT = 0.75      # part of the cache ttl after which a listing is renewed
+
+
+class Warmer(object):
+    """crawl `paths` ({path: depth}) of `provider` in background
+
+    depth 0 renews only the folder itself, depth n also the folders up to
+    n levels below it.
+    """
+    def __init__(self, provider, paths, interval=5*60, workers=2, rate=2.0):
+        self.provider = provider
+        self.paths = paths
+        self.interval = interval
+        self.workers = workers
+        self.rate = rate
+        self.next_call = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name="warmer")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def _run(self):
+        while True:
+            began = time.time()
+            try:
+                count = self.warm()
+                _logger.info("warmed %d folders in %.1fs" % (count, time.time() - began))
+            except Exception as e:
+                _logger.error("warm pass failed: %s" % e)
+            time.sleep(max(self.interval - (time.time() - began), 0))
+
+    def warm(self):
+        """one pass over the hot paths, returns the number of folders visited"""
+        todo = deque(sorted(self.paths.items()))
+        pending = deque()
+        seen = set()
+        count = 0
+        while todo or pending:
+            while todo and len(pending) < self.workers:
+                path, depth = todo.popleft()
+                if path in seen:
+                    continue
+                seen.add(path)
+                pending.append((path, depth, _engine.meta.submit(None, self._visit, path)))
+            if not pending:
+                continue
+            path, depth, task = pending.popleft()
+            try:
+                folders = task.wait()
+            except Exception as e:
+                _logger.error("fail to warm %s: %s" % (path, e))
+                continue
+            count += 1
+            if depth > 0:
+                todo.extend((p, depth-1) for p in folders)
+        return count
+
+    def take(self):
+        """wait until the rate budget allows one more upstream call"""
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + 1.0/self.rate
+        if delay > 0:
+            time.sleep(delay)
+
+    def _visit(self, path):
+        """renew the listing of path if needed, returns the paths of its subfolders"""
+        provider = self.provider
+        environ = {"wsgidav.provider": provider}
+        coll = provider.getResourceInst(path, environ)
+        if coll is None or not coll.isCollection:
+            _logger.warning("cannot warm %s: no folder" % path)
+            return []
+        cache = provider.dircache
+        max_age = cache.ttl * WARM_AT
+        ent = cache.peek(coll.rpath)
+        if ent is None or time.time() - ent[0] >= max_age:
+            self.take()
+            coll.refresh(max_age)
+        members = coll.getMemberList()
+        hook = getattr(provider, "warm_members", None)
+        if hook is not None:
+            hook(coll, members, self.take)
+        return [m.path for m in members if m.isCollection]